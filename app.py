@@ -1,81 +1,454 @@
 import os
 import re
+import functools
 import json, random
+import threading
+import time
+import uuid
 from markupsafe import Markup
-from flask import Flask, render_template, g, send_from_directory, abort, url_for, request
+from flask import Flask, render_template, g, send_from_directory, abort, url_for, request, jsonify
+from werkzeug.routing import BaseConverter
 import sqlite3
 
+import metrics
+from corpus import Corpus, read_build_version
+from planner import RoutePlanner
+from pagecache import CacheWarmer, PageCache, SectionPage
+from popularity import COMBAT, PopularityRecorder
+from progress import ProgressStore
+from render import render_section
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "data", "lonewolf.db")
-IMAGE_ROOT = os.path.join(BASE_DIR, "project-aon-master", "en", "jpeg")
+AON_ROOT = os.path.join(BASE_DIR, "project-aon-master")
+
+# Langue servie sans préfixe d'URL (/play/...) ; les autres sous /<langue>/play/...
+DEFAULT_LANGUAGE = "en"
+# Formats d’images d’illustrations, par ordre de préférence (Project Aon stocke souvent en gif/png)
+IMAGE_FORMATS = ("png", "jpeg", "gif")
+# Séries traduites -> série d'origine (langue par défaut) : les illustrations non livrées
+# dans la traduction sont reprises du livre original de même numéro (es/ls/01hdlo -> en/lw/01fftd)
+SERIES_ORIGINALS = {"ls": "lw"}
 
-# Prépare les racines d’images d’illustrations (Project Aon stocke souvent en gif/png)
-GIF_ROOT = os.path.join(BASE_DIR, "project-aon-master", "en", "gif")
-PNG_ROOT = os.path.join(BASE_DIR, "project-aon-master", "en", "png")
-JPEG_ROOT = os.path.join(BASE_DIR, "project-aon-master", "en", "jpeg")  # parfois utilisé
+def image_root(lang, fmt):
+    """project-aon-master/<lang>/<fmt> (couvertures en jpeg, illustrations en png/jpeg/gif)."""
+    return os.path.join(AON_ROOT, lang, fmt)
 
 # essaie de charger un CRT externe si dispo (facultatif)
 CRT_PATH = os.path.join(BASE_DIR, "project-aon-master", "common", "rules", "crt.json")
 
+# Mode "corpus en mémoire" : toutes les lectures se font sans SQL (voir corpus.py)
+MEMORY_MODE = os.environ.get("LONEWOLF_MEMORY", "0") == "1"
+# Intervalle (s) entre deux vérifications de la version du build de la base
+BUILD_CHECK_INTERVAL = float(os.environ.get("LONEWOLF_BUILD_CHECK", "5"))
+# Progression des lecteurs (base séparée, écrite par lots ; voir progress.py)
+PROGRESS_DB_PATH = os.environ.get("LONEWOLF_PROGRESS_DB", os.path.join(BASE_DIR, "data", "progress.db"))
+PROGRESS_ENABLED = os.environ.get("LONEWOLF_PROGRESS", "1") == "1"
+READER_COOKIE = "lw_reader"
+# Cache des sections rendues et préchauffage des cibles de choix (voir pagecache.py)
+PAGE_CACHE_SIZE = int(os.environ.get("LONEWOLF_PAGE_CACHE", "4096"))
+WARM_ENABLED = os.environ.get("LONEWOLF_WARM", "0") == "1"
+WARM_THREADS = int(os.environ.get("LONEWOLF_WARM_THREADS", "1"))
+# Popularité des sections (voir popularity.py) et préchargement des plus lues
+POPULARITY_DB_PATH = os.environ.get("LONEWOLF_POPULARITY_DB", os.path.join(BASE_DIR, "data", "popularity.db"))
+POPULARITY_ENABLED = os.environ.get("LONEWOLF_POPULARITY", "1") == "1"
+PRELOAD_TOP = int(os.environ.get("LONEWOLF_PRELOAD", "500"))
+
 app = Flask(__name__)
+metrics.init_app(app)
+
+
+# ---------- Langues ----------
+
+class LanguageConverter(BaseConverter):
+    regex = "[a-z]{2}"
+
+app.url_map.converters["lang"] = LanguageConverter
+
+# Endpoints enregistrés par lang_route (acceptent une langue)
+LANG_ENDPOINTS = set()
+
+def lang_route(rule, **options):
+    """
+    Enregistre la route deux fois : sans préfixe pour la langue par défaut
+    (URLs existantes inchangées) et sous /<lang>/ pour les autres langues.
+    """
+    def decorator(f):
+        defaults = options.pop("defaults", None) or {}
+        endpoint = options.pop("endpoint", f.__name__)
+        app.add_url_rule(rule, endpoint, f, defaults={**defaults, "lang": DEFAULT_LANGUAGE}, **options)
+        app.add_url_rule("/<lang:lang>" + rule, endpoint, f, defaults=defaults or None, **options)
+        LANG_ENDPOINTS.add(endpoint)
+        return f
+    return decorator
+
+@app.url_value_preprocessor
+def pull_language(endpoint, values):
+    if values and "lang" in values:
+        g.lang = values.pop("lang")
+
+@app.url_defaults
+def add_language(endpoint, values):
+    # url_for(...) dans une page reste dans la langue de la page
+    if endpoint in LANG_ENDPOINTS and "lang" not in values:
+        values["lang"] = g.get("lang", DEFAULT_LANGUAGE)
+
+def current_language():
+    return g.get("lang", DEFAULT_LANGUAGE)
+
+def book_key(book):
+    """Clé du livre pour la progression : code seul pour la langue par défaut, sinon "<lang>/<code>"."""
+    if book["language"] == DEFAULT_LANGUAGE:
+        return book["code"]
+    return f"{book['language']}/{book['code']}"
+
+def split_book_key(key):
+    """Inverse de book_key : (langue, code)."""
+    language, sep, code = key.rpartition("/")
+    return (language, code) if sep else (DEFAULT_LANGUAGE, code)
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DB_PATH)
+        g.db = metrics.connect(DB_PATH)
         g.db.row_factory = sqlite3.Row
     return g.db
 
+PROGRESS = ProgressStore(PROGRESS_DB_PATH) if PROGRESS_ENABLED else None
+POPULARITY = PopularityRecorder(POPULARITY_DB_PATH) if POPULARITY_ENABLED else None
+
+def reader_id():
+    """Identifiant anonyme du lecteur (cookie), créé à la première visite."""
+    if 'reader_id' not in g:
+        rid = request.cookies.get(READER_COOKIE, "")
+        if not re.fullmatch(r"[0-9a-f]{32}", rid):
+            rid = uuid.uuid4().hex
+            g.new_reader = True
+        g.reader_id = rid
+    return g.reader_id
+
+def get_progress(book):
+    if PROGRESS is None:
+        return None
+    return PROGRESS.get(reader_id(), book_key(book))
+
+@app.after_request
+def set_reader_cookie(response):
+    if g.get("new_reader"):
+        response.set_cookie(READER_COOKIE, g.reader_id, max_age=365 * 24 * 3600, httponly=True, samesite="Lax")
+    return response
+
 @app.teardown_appcontext
 def close_db(exception):
     db = g.pop('db', None)
     if db is not None:
         db.close()
 
-def get_books_by_category():
-    """Utilise la colonne books.category pour regrouper."""
+
+# ---------- Corpus en mémoire & version du build ----------
+
+CORPUS = None
+# corpus et générations des caches (sections rendues, planificateur) remplacés ensemble :
+# une requête commencée avant un rechargement ne remplit pas les caches du nouveau build
+_snapshot = (None, 0, 0)
+_build = {"version": None, "checked": 0.0}
+_build_lock = threading.Lock()
+_reload_lock = threading.Lock()
+
+def load_corpus():
+    """Charge (ou recharge) le corpus, puis le met en service avec des caches vides."""
+    corpus = Corpus.load(DB_PATH)
+    swap_build(corpus)
+    st = corpus.stats
+    app.logger.info(
+        "Corpus en mémoire (build %s) : %d livres, %d sections, chargé en %.2f s",
+        corpus.build_version, st["books"], st["sections"], st["load_seconds"]
+    )
+    return corpus
+
+def swap_build(corpus=None):
+    """Met en service un nouveau build (corpus déjà chargé en mode mémoire) et vide les caches."""
+    global CORPUS, _snapshot
+    PAGE_CACHE.clear()
+    PLANNER.clear()
+    CORPUS = corpus
+    _snapshot = (corpus, PAGE_CACHE.generation, PLANNER.generation)
+
+def get_snapshot():
+    """(corpus, génération du cache des sections, génération du planificateur), figé pour la requête."""
+    if 'snapshot' not in g:
+        g.snapshot = _snapshot
+    return g.snapshot
+
+def get_corpus():
+    """Instantané du corpus pour toute la requête (None en mode SQL)."""
+    return get_snapshot()[0]
+
+def reload_build():
+    """Charge le nouveau build, le met en service, puis précharge ses sections populaires."""
+    with _reload_lock:
+        if MEMORY_MODE:
+            load_corpus()
+        else:
+            swap_build()
+        preload_popular()
+
+def on_build_change(background=True):
+    """
+    Appelé quand la base a été regénérée (nouvelle build_version). Le rechargement se
+    fait hors requête (sauf demande : serve.py, avant fork) ; en attendant, les requêtes
+    continuent sur l'ancien build.
+    """
+    if background:
+        threading.Thread(target=reload_build, name="reload-build", daemon=True).start()
+    else:
+        reload_build()
+
+@app.before_request
+def check_build_version():
+    now = time.monotonic()
+    if now - _build["checked"] < BUILD_CHECK_INTERVAL:
+        return
+    # une seule requête vérifie / recharge ; les autres continuent sur l'ancien état
+    if not _build_lock.acquire(blocking=False):
+        return
+    try:
+        _build["checked"] = now
+        version = read_build_version(DB_PATH)
+        if _build["version"] is None:
+            _build["version"] = version
+        elif version != _build["version"]:
+            _build["version"] = version
+            on_build_change()
+    finally:
+        _build_lock.release()
+
+
+# ---------- Accès aux données (SQL ou corpus) ----------
+
+def fetch_languages():
+    corpus = get_corpus()
+    if corpus:
+        return list(corpus.by_language)
+    return [r["language"] for r in get_db().execute("SELECT DISTINCT language FROM books ORDER BY language")]
+
+def fetch_books(lang):
+    corpus = get_corpus()
+    if corpus:
+        return corpus.language_books(lang)
+    return get_db().execute("SELECT * FROM books WHERE language = ? ORDER BY code", (lang,)).fetchall()
+
+def fetch_book(lang, code):
+    corpus = get_corpus()
+    if corpus:
+        return corpus.book(lang, code.lower())
+    return get_db().execute(
+        "SELECT * FROM books WHERE language = ? AND code = ?", (lang, code.lower())
+    ).fetchone()
+
+def fetch_section(book, sec_id):
+    corpus = get_corpus()
+    if corpus:
+        return corpus.section(book, sec_id)
+    return get_db().execute(
+        "SELECT * FROM sections WHERE book_id=? AND sec_id=?",
+        (book["id"], sec_id)
+    ).fetchone()
+
+def fetch_section_by_key(book, key, sec_id):
+    """Section par son id (links.to_section) ; None si l'id ne désigne plus (book, sec_id)."""
+    corpus = get_corpus()
+    if corpus:
+        s = corpus.section_by_rowid(key)
+    else:
+        s = get_db().execute("SELECT * FROM sections WHERE id=?", (key,)).fetchone()
+    # id d'un build précédent (page ouverte avant une régénération) : on retombe sur sec_id
+    if s is None or s["book_id"] != book["id"] or s["sec_id"] != sec_id:
+        return None
+    return s
+
+def fetch_first_section(book):
+    """sect1 ; sinon, fallback = plus petit numéro de 'sectXXX'."""
+    corpus = get_corpus()
+    if corpus:
+        s = corpus.section(book, "sect1")
+        if s:
+            return s
+        numbered = [x for x in corpus.book_sections(book) if x.sec_id.startswith("sect") and x.sec_id[4:].isdigit()]
+        return min(numbered, key=lambda x: int(x.sec_id[4:])) if numbered else None
+
+    db = get_db()
+    s = db.execute("""
+        SELECT * FROM sections
+        WHERE book_id=?
+          AND sec_id='sect1'
+        LIMIT 1
+    """, (book["id"],)).fetchone()
+
+    if not s:
+        s = db.execute("""
+            SELECT * FROM sections
+            WHERE book_id=? AND sec_id LIKE 'sect%'
+            ORDER BY CAST(SUBSTR(sec_id, 5) AS INT) ASC
+            LIMIT 1
+        """, (book["id"],)).fetchone()
+    return s
+
+def fetch_choices(book, section):
+    """❗ On ne prend que les CHOIX (pas les prev/next)."""
+    corpus = get_corpus()
+    if corpus:
+        return corpus.choices(section)
+    return get_db().execute("""
+        SELECT to_sec_ref, to_section, COALESCE(display_text, to_sec_ref) AS label
+        FROM links
+        WHERE book_id=? AND from_section=? AND rel='choice'
+        ORDER BY id
+    """, (book["id"], section["id"])).fetchall()
+
+def fetch_images(book, section):
+    corpus = get_corpus()
+    if corpus:
+        return corpus.images(section)
+    return get_db().execute("""
+        SELECT src, width, height, mime_type, variant_class
+        FROM images WHERE book_id=? AND section_id=?
+        ORDER BY id
+    """, (book["id"], section["id"])).fetchall()
+
+def fetch_combat(section):
+    """(combat_id, ennemis) du premier combat de la section, ou None."""
+    corpus = get_corpus()
+    if corpus:
+        return corpus.combat(section)
     db = get_db()
-    books = db.execute("SELECT * FROM books ORDER BY code").fetchall()
+    combat = db.execute("SELECT id FROM combats WHERE section_id=? ORDER BY id LIMIT 1", (section["id"],)).fetchone()
+    if not combat:
+        return None
+    enemies = db.execute("""
+        SELECT * FROM combat_enemies WHERE combat_id=? ORDER BY enemy_index
+    """, (combat["id"],)).fetchall()
+    return combat["id"], enemies
+
+def graph_source():
+    """Source pour le planificateur : le corpus s'il est chargé, sinon la base."""
+    return get_corpus() or get_db()
+
+def plan_route(book, sec_id, lw_cs, lw_ep):
+    return PLANNER.plan(graph_source(), book["id"], sec_id, lw_cs, lw_ep, generation=get_snapshot()[2])
+
+
+def get_books_by_category(lang):
+    """Utilise la colonne books.category pour regrouper."""
+    books = fetch_books(lang)
     grouped = {"lw": [], "gs": [], "fw": []}
     for b in books:
         cat = (b["category"] or "lw").lower()
         grouped.setdefault(cat, []).append(b)
     return grouped
 
-@app.route("/")
+@lang_route("/")
 def index():
-    books_by_cat = get_books_by_category()
-    return render_template("index.html", books_by_cat=books_by_cat)
+    lang = current_language()
+    languages = fetch_languages()
+    if lang != DEFAULT_LANGUAGE and lang not in languages:
+        abort(404)
+    books_by_cat = get_books_by_category(lang)
+    return render_template("index.html", books_by_cat=books_by_cat, languages=languages, lang=lang)
 
-@app.route("/book/<code>")
+@lang_route("/book/<code>")
 def book_detail(code):
-    db = get_db()
-    book = db.execute("SELECT * FROM books WHERE code = ?", (code.lower(),)).fetchone()
+    book = fetch_book(current_language(), code)
     if not book:
         abort(404)
     cover_url = url_for('cover', cat=book['category'], code=book['code'])
-    return render_template("book.html", book=book, cover_url=cover_url)
+    return render_template("book.html", book=book, cover_url=cover_url, progress=get_progress(book))
 
-@app.route("/cover/<cat>/<code>")
+@lang_route("/cover/<cat>/<code>")
 def cover(cat, code):
     """
-    Sert l'image de couverture selon la catégorie et le code.
+    Sert l'image de couverture selon la langue, la catégorie et le code
+    (traduction sans couverture : celle du livre original).
     """
-    base_dir = os.path.join(IMAGE_ROOT, cat, code, "skins", "ebook")
-    for filename in ("cover.jpg", "cover.jpeg", "cover.png"):
-        path = os.path.join(base_dir, filename)
-        if os.path.isfile(path):
-            return send_from_directory(base_dir, filename)
+    lang = current_language()
+    candidates = [(lang, cat, code)]
+    original = original_book(lang, cat, code)
+    if original:
+        candidates.append(original)
+    for c_lang, c_cat, c_code in candidates:
+        base_dir = os.path.join(image_root(c_lang, "jpeg"), c_cat, c_code, "skins", "ebook")
+        for filename in ("cover.jpg", "cover.jpeg", "cover.png"):
+            path = os.path.join(base_dir, filename)
+            if os.path.isfile(path):
+                return send_from_directory(base_dir, filename)
     abort(404)
 
-def resolve_illu_url(category: str, code: str, rel_src: str):
+# Index des fichiers images : (lang, fmt, cat, code) -> (chemins relatifs, basename minuscule -> chemin)
+# Construit une seule fois (un os.walk par racine) au lieu d'un os.walk par illustration.
+_ASSET_INDEX = None
+_asset_lock = threading.Lock()
+
+def build_asset_index():
+    index = {}
+    languages = sorted(d for d in os.listdir(AON_ROOT) if os.path.isdir(os.path.join(AON_ROOT, d, "xml")))
+    for lang, fmt in ((lang, fmt) for lang in languages for fmt in IMAGE_FORMATS):
+        base_root = image_root(lang, fmt)
+        if not os.path.isdir(base_root):
+            continue
+        for cat in sorted(os.listdir(base_root)):
+            cat_dir = os.path.join(base_root, cat)
+            if not os.path.isdir(cat_dir):
+                continue
+            for code in sorted(os.listdir(cat_dir)):
+                code_dir = os.path.join(cat_dir, code)
+                if not os.path.isdir(code_dir):
+                    continue
+                paths, by_name = set(), {}
+                for root, _dirs, files in os.walk(code_dir):
+                    for f in files:
+                        rel = os.path.relpath(os.path.join(root, f), code_dir).replace("\\", "/")
+                        paths.add(rel)
+                        by_name.setdefault(f.lower(), rel)
+                index[(lang, fmt, cat, code)] = (paths, by_name)
+    return index
+
+def get_asset_index():
+    global _ASSET_INDEX
+    if _ASSET_INDEX is None:
+        with _asset_lock:
+            if _ASSET_INDEX is None:
+                _ASSET_INDEX = build_asset_index()
+    return _ASSET_INDEX
+
+@functools.lru_cache(maxsize=None)
+def original_book(lang: str, category: str, code: str):
+    """(langue, catégorie, code) du livre original d'une traduction, ou None."""
+    original_cat = SERIES_ORIGINALS.get(category)
+    if lang == DEFAULT_LANGUAGE or not original_cat:
+        return None
+    number = code[:2]
+    for (l, _fmt, cat, c) in get_asset_index():
+        if l == DEFAULT_LANGUAGE and cat == original_cat and c[:2] == number:
+            return (l, cat, c)
+    return None
+
+@metrics.timed("resolve_illu_url")
+def resolve_illu_url(lang: str, category: str, code: str, rel_src: str):
     """
     Résout l'URL d'une illustration en testant PNG -> JPEG -> GIF.
     1) Essaye le chemin donné (normalisé) et /ill/<basename>
-    2) Si introuvable, cherche récursivement le basename sous en/<fmt>/<cat>/<code>/**
+    2) Si introuvable, cherche le basename sous <lang>/<fmt>/<cat>/<code>/** (via l'index des assets)
+    3) Traduction : à défaut, mêmes essais dans le livre original (voir SERIES_ORIGINALS)
     """
     if not rel_src:
         return None
-
+    url = _resolve_illu_url(lang, category, code, rel_src)
+    if url is None:
+        original = original_book(lang, category, code)
+        if original:
+            url = _resolve_illu_url(*original, rel_src)
+    return url
+
+def _resolve_illu_url(lang: str, category: str, code: str, rel_src: str):
     # normaliser le src
     rel_src_norm = rel_src.replace("\\", "/").lstrip("./")
     rel_src_norm = os.path.normpath(rel_src_norm).replace("\\", "/")
@@ -86,82 +459,39 @@ def resolve_illu_url(category: str, code: str, rel_src: str):
     if not rel_src_norm.lower().startswith("ill/") and basename:
         direct_candidates_rel.append(f"ill/{basename}")
 
-    roots = [("png", PNG_ROOT), ("jpeg", JPEG_ROOT), ("gif", GIF_ROOT)]
-    tried = []
+    index = get_asset_index()
 
     # 1) essais directs
-    for fmt, base_root in roots:
-        for rel_try in direct_candidates_rel:
-            fullpath = os.path.join(base_root, category, code, rel_try.replace("/", os.sep))
-            if os.path.isfile(fullpath):
-                return url_for("illu", fmt=fmt, cat=category, code=code, path=rel_try)
-            tried.append(fullpath)
-
-    # 2) recherche récursive sur le basename
-    for fmt, base_root in roots:
-        code_dir = os.path.join(base_root, category, code)
-        if not os.path.isdir(code_dir):
+    for fmt in IMAGE_FORMATS:
+        entry = index.get((lang, fmt, category, code))
+        if not entry:
             continue
-        # walk une seule fois par fmt
-        for root, _dirs, files in os.walk(code_dir):
-            # match case-insensitive sur le basename
-            for f in files:
-                if f.lower() == basename.lower():
-                    abs_found = os.path.join(root, f)
-                    # chemin relatif depuis <fmt>/<cat>/<code>
-                    rel_found = os.path.relpath(abs_found, code_dir).replace("\\", "/")
-                    return url_for("illu", fmt=fmt, cat=category, code=code, path=rel_found)
+        for rel_try in direct_candidates_rel:
+            if rel_try in entry[0]:
+                return url_for("illu", lang=lang, fmt=fmt, cat=category, code=code, path=rel_try)
+
+    # 2) recherche sur le basename (insensible à la casse)
+    for fmt in IMAGE_FORMATS:
+        entry = index.get((lang, fmt, category, code))
+        if entry and basename.lower() in entry[1]:
+            return url_for("illu", lang=lang, fmt=fmt, cat=category, code=code, path=entry[1][basename.lower()])
 
     return None
 
 
-def _render_content_xml(xml: str) -> str:
-    """
-    Rendu HTML très simple/tolérant du content_xml.
-    - Remplace quelques balises Project Aon par du HTML.
-    - Échappe ce qu'il faut le moins possible (ici, on suppose content_xml est clean).
-    Adapte au besoin si tu veux un rendu plus riche.
-    """
-    if not xml:
-        return ""
-    # Entités custom (si tu n'as pas déjà fait le nettoyage à l'import)
-    replacements = {
-        "<ch.apos/>": "'",
-        "<ch.ndash/>": "-",
-        "<ch.mdash/>": "—",
-        "<ch.hellip/>": "…",
-        "<ch.amp/>": "&",
-    }
-    for k, v in replacements.items():
-        xml = xml.replace(k, v)
-    # Balises simples -> HTML
-    xml = re.sub(r"</?para>", "", xml, flags=re.IGNORECASE)         # on laisse gérer les sauts par <br> ou <p> si besoin
-    xml = re.sub(r"<emphasis>", "<em>", xml, flags=re.IGNORECASE)
-    xml = re.sub(r"</emphasis>", "</em>", xml, flags=re.IGNORECASE)
-    xml = re.sub(r"<strong>", "<strong>", xml, flags=re.IGNORECASE)
-    xml = re.sub(r"</strong>", "</strong>", xml, flags=re.IGNORECASE)
-    # Liste rapide (si présent)
-    xml = re.sub(r"<list>", "<ul>", xml, flags=re.IGNORECASE)
-    xml = re.sub(r"</list>", "</ul>", xml, flags=re.IGNORECASE)
-    xml = re.sub(r"<item>", "<li>", xml, flags=re.IGNORECASE)
-    xml = re.sub(r"</item>", "</li>", xml, flags=re.IGNORECASE)
-    # Nettoyage choix/illustrations restés (on n'affiche pas les <choice> bruts)
-    xml = re.sub(r"<choice\b.*?>.*?</choice>", "", xml, flags=re.IGNORECASE | re.DOTALL)
-    xml = re.sub(r"<illustration\b.*?>.*?</illustration>", "", xml, flags=re.IGNORECASE | re.DOTALL)
-    # Paragraphes basiques : split sur double saut
-    parts = [p.strip() for p in re.split(r"\n\s*\n", xml) if p.strip()]
-    html = "".join(f"<p>{p}</p>" for p in parts) if parts else xml
-    return html
-
-@app.route("/illu/<fmt>/<cat>/<code>/<path:path>")
+@metrics.timed("render_content_xml")
+def _render_content_xml(xml: str, section_url=None, illustration_url=None) -> str:
+    """Rendu HTML du content_xml (une passe, voir render.py)."""
+    return render_section(xml, section_url=section_url, illustration_url=illustration_url)
+
+@lang_route("/illu/<fmt>/<cat>/<code>/<path:path>")
 def illu(fmt, cat, code, path):
     """
-    Sert une illustration depuis en/{gif|png|jpeg}/<cat>/<code>/<path>.
+    Sert une illustration depuis <lang>/{gif|png|jpeg}/<cat>/<code>/<path>.
     """
-    root_map = {"gif": GIF_ROOT, "png": PNG_ROOT, "jpeg": JPEG_ROOT}
-    base = root_map.get(fmt.lower())
-    if not base:
+    if fmt.lower() not in IMAGE_FORMATS:
         abort(404)
+    base = image_root(current_language(), fmt.lower())
     dir_path = os.path.join(base, cat, code, os.path.dirname(path))
     filename = os.path.basename(path)
     full = os.path.join(dir_path, filename)
@@ -216,45 +546,215 @@ def resolve_round(cs_diff, crt, roll):
             e_dmg = max(0, base + bonus - 1)
             lw_dmg = base - bonus + 1
         return (max(0, e_dmg), max(0, lw_dmg))
-    
+
+# Planificateur de route (graphes par livre gardés en mémoire + cache des résultats)
+PLANNER = RoutePlanner(resolve_round, CRT)
+metrics.register_cache("route_planner", lambda: (PLANNER.hits, PLANNER.misses))
+metrics.register_gauge("lonewolf_corpus_load_seconds", "Durée du dernier chargement du corpus",
+                       lambda: CORPUS.stats["load_seconds"] if CORPUS else 0)
+if PROGRESS is not None:
+    metrics.register_gauge("lonewolf_progress_pending", "Mises à jour de progression en attente d'écriture",
+                           lambda: PROGRESS.pending)
+    metrics.register_gauge("lonewolf_progress_flushed_rows", "Lignes de progression écrites (cumul)",
+                           lambda: PROGRESS.flushed_rows)
+
+# ---------- Sections rendues (cache + préchauffage) ----------
+
+PAGE_CACHE = PageCache(PAGE_CACHE_SIZE)
+
+def build_section_page(book, section) -> SectionPage:
+    """Texte rendu, illustrations, choix et combat d'une section (sans rien du lecteur)."""
+    # y a-t-il un combat dans cette section ?
+    combat = fetch_combat(section)
+
+    choices = fetch_choices(book, section)
+
+    # Illustrations de la section (identique à avant)
+    illus = fetch_images(book, section)
+
+    # Illustrations "inline" rendues dans le texte ; les autres vont dans le panneau
+    inline_urls = []
+    def inline_illustration(src):
+        u = resolve_illu_url(book["language"], book["category"], book["code"], src)
+        if u:
+            inline_urls.append(u)
+        return u
+
+    content_html = Markup(_render_content_xml(
+        section["content_xml"],
+        section_url=lambda ref: url_for("play", lang=book["language"], code=book["code"], sec_id=ref),
+        illustration_url=inline_illustration,
+    ))
+
+    # Illustrations associées -> on construit les URLs avec fallback PNG -> JPEG -> GIF
+    illu_urls = []
+    for im in illus:
+        u = resolve_illu_url(book["language"], book["category"], book["code"], im["src"])
+        if u and u not in inline_urls:
+            illu_urls.append(u)
+
+    return SectionPage(content_html, illu_urls, choices, combat[0] if combat else None)
+
+def get_section_page(book, section) -> SectionPage:
+    key = (book["id"], section["sec_id"])
+    page = PAGE_CACHE.get(key, count_miss=WARMER is None)
+    if page is None and WARMER is not None:
+        # cible en cours de rendu dans le pool : on attend plutôt que de la rendre en double
+        page = PAGE_CACHE.get(key) if WARMER.wait(key) else PAGE_CACHE.get(key, count_miss=True)
+    if page is None:
+        generation = get_snapshot()[1]
+        page = build_section_page(book, section)
+        PAGE_CACHE.put(key, page, generation=generation)
+    return page
+
+def warm_section(payload) -> None:
+    """Thread du CacheWarmer : rend une cible de choix hors requête."""
+    book, sec_id, key, url_root, generation = payload
+    # contexte de requête minimal : url_for, get_db() / get_corpus()
+    with app.test_request_context(base_url=url_root):
+        section = fetch_section_by_key(book, key, sec_id) if key is not None else fetch_section(book, sec_id)
+        if section is not None:
+            PAGE_CACHE.put((book["id"], sec_id), build_section_page(book, section),
+                           warmed=True, generation=generation)
+
+def warm_choices(book, choices) -> None:
+    """Propose les cibles des choix de la page au préchauffage (ne bloque jamais)."""
+    url_root, generation = request.url_root, get_snapshot()[1]
+    for c in choices:
+        ref = c["to_sec_ref"]
+        WARMER.submit((book["id"], ref), (book, ref, c["to_section"], url_root, generation))
+
+# Requêtes en cours : le préchauffage ne s'exécute que lorsque le serveur est inactif
+_inflight = {"n": 0}
+_inflight_lock = threading.Lock()
+SERVER_IDLE = threading.Event()
+SERVER_IDLE.set()
+
+WARMER = CacheWarmer(PAGE_CACHE, warm_section, idle=SERVER_IDLE, threads=WARM_THREADS) if WARM_ENABLED else None
+
+if WARMER is not None:
+    @app.before_request
+    def _request_started():
+        g.inflight = True
+        with _inflight_lock:
+            _inflight["n"] += 1
+            SERVER_IDLE.clear()
+
+    @app.teardown_request
+    def _request_finished(exception):
+        # les contextes de warm_section() ne passent pas par before_request
+        if not g.pop("inflight", False):
+            return
+        with _inflight_lock:
+            _inflight["n"] -= 1
+            if _inflight["n"] == 0:
+                SERVER_IDLE.set()
+
+metrics.register_cache("section_pages", lambda: (PAGE_CACHE.hits, PAGE_CACHE.misses))
+metrics.register_gauge("lonewolf_page_cache_entries", "Sections rendues en cache", lambda: len(PAGE_CACHE))
+metrics.register_gauge("lonewolf_warm_pages_total", "Sections préchauffées (cumul)", lambda: PAGE_CACHE.warmed)
+metrics.register_gauge("lonewolf_warm_used_total", "Sections préchauffées ensuite servies (cumul)",
+                       lambda: PAGE_CACHE.warm_used)
+metrics.register_gauge("lonewolf_warm_wasted_total", "Sections préchauffées évincées sans avoir servi (cumul)",
+                       lambda: PAGE_CACHE.warm_wasted)
+if WARMER is not None:
+    metrics.register_gauge("lonewolf_warm_queue_depth", "Cibles en attente de préchauffage",
+                           lambda: WARMER.depth)
+    metrics.register_gauge("lonewolf_warm_dropped_total", "Cibles abandonnées (file pleine, cumul)",
+                           lambda: WARMER.dropped)
+    metrics.register_gauge("lonewolf_warm_deduped_total", "Cibles ignorées (déjà en cache ou en file, cumul)",
+                           lambda: WARMER.deduped)
+    metrics.register_gauge("lonewolf_warm_stale_total", "Cibles abandonnées (serveur resté occupé, cumul)",
+                           lambda: WARMER.stale)
+
+def preload_popular(n=None) -> int:
+    """
+    Rend dans le cache les n sections les plus populaires (PRELOAD_TOP par défaut) :
+    au démarrage et après chaque nouveau build, un worker sert ces pages à chaud dès sa
+    première requête. Construit aussi l'index des images. Après un rechargement, appelé
+    une fois le nouveau build en service (reload_build) : pages rendues depuis le nouveau
+    corpus, sous la génération du cache correspondante.
+    """
+    n = min(PRELOAD_TOP if n is None else n, PAGE_CACHE.size)
+    if POPULARITY is None or n <= 0:
+        return 0
+    started = time.perf_counter()
+    get_asset_index()
+    loaded = 0
+    try:
+        top = POPULARITY.top(n)
+        # contexte de requête minimal (url_for, get_db()) ; liens sous APPLICATION_ROOT
+        with app.test_request_context():
+            generation = get_snapshot()[1]
+            books = {}
+            for key, sec_id, _score in top:
+                if key not in books:
+                    books[key] = fetch_book(*split_book_key(key))
+                book = books[key]
+                section = fetch_section(book, sec_id) if book else None
+                if section is None:
+                    continue
+                PAGE_CACHE.put((book["id"], sec_id), build_section_page(book, section), generation=generation)
+                loaded += 1
+    except sqlite3.Error as e:
+        app.logger.warning("Préchargement des sections populaires impossible : %s", e)
+        return loaded
+    PRELOAD_STATS.update(sections=loaded, seconds=time.perf_counter() - started)
+    app.logger.info("Préchargement : %d sections populaires en %.2f s", loaded, PRELOAD_STATS["seconds"])
+    return loaded
+
+PRELOAD_STATS = {"sections": 0, "seconds": 0.0}
+metrics.register_gauge("lonewolf_preload_sections", "Sections populaires préchargées (dernier préchargement)",
+                       lambda: PRELOAD_STATS["sections"])
+metrics.register_gauge("lonewolf_preload_seconds", "Durée du dernier préchargement",
+                       lambda: PRELOAD_STATS["seconds"])
+if POPULARITY is not None:
+    metrics.register_gauge("lonewolf_popularity_pending", "Hits de popularité en attente d'écriture",
+                           lambda: POPULARITY.pending)
+    metrics.register_gauge("lonewolf_popularity_flushed_hits", "Hits de popularité écrits (cumul)",
+                           lambda: POPULARITY.flushed_hits)
+
+def _int_arg(name):
+    try:
+        return int(request.args[name])
+    except (KeyError, ValueError):
+        return None
+
 
 
 # ---------- Combat: vues ----------
 
-@app.route("/combat/<code>/<sec_id>", methods=["GET"])
+@lang_route("/combat/<code>/<sec_id>", methods=["GET"])
 def combat_view(code, sec_id):
     """
     Page de préparation OU reprise d'un combat si état transmis en query (facultatif).
     Affiche la liste d'ennemis détectés pour préremplir CS/EP.
     """
-    db = get_db()
-    book = db.execute("SELECT * FROM books WHERE code=?", (code.lower(),)).fetchone()
+    book = fetch_book(current_language(), code)
     if not book: abort(404)
-    section = db.execute("SELECT * FROM sections WHERE book_id=? AND sec_id=?", (book["id"], sec_id)).fetchone()
+    section = fetch_section(book, sec_id)
     if not section: abort(404)
 
-    combat = db.execute("SELECT * FROM combats WHERE section_id=?", (section["id"],)).fetchone()
+    combat = fetch_combat(section)
     if not combat:
         # Pas de combat pour cette section
         return render_template("combat.html", book=book, section=section, enemies=[], state=None)
 
-    enemies = db.execute("""
-        SELECT * FROM combat_enemies WHERE combat_id=? ORDER BY enemy_index
-    """, (combat["id"],)).fetchall()
+    _combat_id, enemies = combat
 
-    # Pas d'état => affiche le formulaire initial
-    return render_template("combat.html", book=book, section=section, enemies=enemies, state=None)
+    # Pas d'état => affiche le formulaire initial (CS/EP préremplis depuis la progression)
+    return render_template("combat.html", book=book, section=section, enemies=enemies, state=None,
+                           progress=get_progress(book))
 
-@app.route("/combat/step/<code>/<sec_id>", methods=["POST"])
+@lang_route("/combat/step/<code>/<sec_id>", methods=["POST"])
 def combat_step(code, sec_id):
     """
     Avance d'UN tour (ou initialise le combat si action=start).
     On sérialise l'état côté client dans des champs hidden (simple et suffisant).
     """
-    db = get_db()
-    book = db.execute("SELECT * FROM books WHERE code=?", (code.lower(),)).fetchone()
+    book = fetch_book(current_language(), code)
     if not book: abort(404)
-    section = db.execute("SELECT * FROM sections WHERE book_id=? AND sec_id=?", (book["id"], sec_id)).fetchone()
+    section = fetch_section(book, sec_id)
     if not section: abort(404)
 
     action = request.form.get("action", "next")
@@ -278,6 +778,10 @@ def combat_step(code, sec_id):
             "round": 0,
             "log": []
         }
+        if PROGRESS is not None:
+            PROGRESS.set_stats(reader_id(), book_key(book), lw_cs, lw_ep)
+        if POPULARITY is not None:
+            POPULARITY.record(book_key(book), section["sec_id"], COMBAT)
     else:
         # Continuer depuis l'état sérialisé
         try:
@@ -310,91 +814,104 @@ def combat_step(code, sec_id):
         "lw_ep": state["lw_ep"]
     })
 
+    # Fin du combat -> issue et EP restant enregistrés (écriture différée)
+    if PROGRESS is not None and (state["lw_ep"] <= 0 or state["enemy_ep"] <= 0):
+        reader = reader_id()
+        won = state["enemy_ep"] <= 0 < state["lw_ep"]
+        PROGRESS.record_combat(reader, book_key(book), section["sec_id"], won, state["round"],
+                               state["lw_ep"], state["enemy_ep"])
+        PROGRESS.set_stats(reader, book_key(book), None, state["lw_ep"])
+
     return render_template("combat.html", book=book, section=section, enemies=[], state=state)
 
 
-@app.route("/play/<code>/")
-@app.route("/play/<code>/<sec_id>")
+# ---------- Conseil d'itinéraire ----------
+
+@lang_route("/api/route/<code>/<sec_id>")
+def api_route(code, sec_id):
+    """
+    Route la plus sûre et route la plus courte vers la fin du livre.
+    Paramètres : ?cs=<Combat Skill>&ep=<Endurance> (ramenés aux bornes du jeu, renvoyés tels qu'utilisés).
+    La survie d'une route reporte l'EP perdu d'un combat sur le suivant.
+    """
+    book = fetch_book(current_language(), code)
+    if not book:
+        abort(404)
+    lw_cs, lw_ep = _int_arg("cs"), _int_arg("ep")
+    if lw_cs is None or lw_ep is None:
+        abort(400)
+    lw_cs, lw_ep = PLANNER.clamp(lw_cs, lw_ep)
+    plan = plan_route(book, sec_id, lw_cs, lw_ep)
+    if plan is None:
+        abort(404)
+    return jsonify(book=book["code"], language=book["language"], start=sec_id, cs=lw_cs, ep=lw_ep, **plan)
+
+
+@lang_route("/play/<code>/")
+@lang_route("/play/<code>/<sec_id>")
 def play(code, sec_id=None):
-    db = get_db()
-    book = db.execute("SELECT * FROM books WHERE code = ?", (code.lower(),)).fetchone()
+    book = fetch_book(current_language(), code)
     if not book:
         abort(404)
 
     # Défaut = sect1 ; sinon, fallback = plus petit numéro de 'sectXXX'
     if not sec_id:
-        s = db.execute("""
-            SELECT * FROM sections
-            WHERE book_id=?
-              AND sec_id='sect1'
-            LIMIT 1
-        """, (book["id"],)).fetchone()
-
-        if not s:
-            s = db.execute("""
-                SELECT * FROM sections
-                WHERE book_id=? AND sec_id LIKE 'sect%'
-                ORDER BY CAST(SUBSTR(sec_id, 5) AS INT) ASC
-                LIMIT 1
-            """, (book["id"],)).fetchone()
-
+        s = fetch_first_section(book)
         if not s:
             abort(404)
         sec_id = s["sec_id"]
 
-    section = db.execute(
-        "SELECT * FROM sections WHERE book_id=? AND sec_id=?",
-        (book["id"], sec_id)
-    ).fetchone()
+    # Clic sur un choix : la cible résolue au build (?k=id) évite la recherche par sec_id
+    key = _int_arg("k")
+    section = fetch_section_by_key(book, key, sec_id) if key is not None else None
+    if section is None:
+        section = fetch_section(book, sec_id)
     if not section:
         abort(404)
 
-    # y a-t-il un combat dans cette section ?
-    combat = get_db().execute("""
-        SELECT c.id AS combat_id
-        FROM combats c
-        WHERE c.section_id = ?
-        LIMIT 1
-    """, (section["id"],)).fetchone()
-
-    has_combat = combat is not None
-
-
-    # ❗ On ne prend que les CHOIX (pas les prev/next)
-    choices = db.execute("""
-        SELECT to_sec_ref, COALESCE(display_text, to_sec_ref) AS label
-        FROM links
-        WHERE book_id=? AND from_section=? AND rel='choice'
-        ORDER BY id
-    """, (book["id"], section["id"])).fetchall()
-
-    # Illustrations de la section (identique à avant)
-    illus = db.execute("""
-        SELECT src, width, height, mime_type, variant_class
-        FROM images WHERE book_id=? AND section_id=?
-        ORDER BY id
-    """, (book["id"], section["id"])).fetchall()
-
-    content_html = Markup(_render_content_xml(section["content_xml"]))
-
-    # Illustrations associées -> on construit les URLs avec fallback PNG -> JPEG -> GIF
-    illu_urls = []
-    for im in illus:
-        u = resolve_illu_url(book["category"], book["code"], im["src"])
-        if u:
-            illu_urls.append(u)
+    # Partie commune à tous les lecteurs : rendue une fois, puis servie depuis le cache
+    page = get_section_page(book, section)
+    if WARMER is not None:
+        warm_choices(book, page.choices)
+    if POPULARITY is not None:
+        POPULARITY.record(book_key(book), section["sec_id"])
+
+    # Progression du lecteur (section courante + sections visitées)
+    progress = None
+    if PROGRESS is not None:
+        PROGRESS.visit(reader_id(), book_key(book), section["sec_id"])
+        progress = get_progress(book)
+
+    # Conseil d'itinéraire si le joueur a renseigné ses CS/EP
+    lw_cs, lw_ep = _int_arg("cs"), _int_arg("ep")
+    route_hint = None
+    if lw_cs is not None and lw_ep is not None:
+        route_hint = plan_route(book, section["sec_id"], lw_cs, lw_ep)
+    elif progress is not None:
+        # formulaire prérempli avec les CS/EP enregistrés ; calcul seulement à la demande
+        lw_cs = lw_cs if lw_cs is not None else progress.lw_cs
+        lw_ep = lw_ep if lw_ep is not None else progress.lw_ep
 
     return render_template(
         "play.html",
         book=book,
         section=section,
-        content_html=content_html,
-        choices=choices,
-        illu_urls=illu_urls,
-        has_combat=has_combat,
-        combat_id=combat["combat_id"] if has_combat else None
+        content_html=page.content_html,
+        choices=page.choices,
+        illu_urls=page.illu_urls,
+        has_combat=page.has_combat,
+        combat_id=page.combat_id,
+        route_hint=route_hint,
+        lw_cs=lw_cs,
+        lw_ep=lw_ep,
+        progress=progress
     )
 
 
+if MEMORY_MODE:
+    _build["version"] = load_corpus().build_version
+
+
 if __name__ == "__main__":
+    preload_popular()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,722 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+benchmark.py
+------------
+Banc d'essai des chemins de service du site.
+
+Sous-commande `traffic` : génère des sessions de lecteurs réalistes en marchant
+au hasard dans le graphe des choix (table links) de chaque livre depuis sect1,
+en engageant les combats rencontrés et en les jouant tour par tour, puis rejoue
+ces sessions :
+  - via le client de test Flask (par défaut, dans le processus),
+  - ou contre un vrai serveur HTTP (--http http://127.0.0.1:8000), avec --concurrency N.
+
+Chaque session a son propre lecteur (cookies conservés de requête en requête).
+Rapport par route (/, /book, /play, /illu, /combat/step) : nombre de requêtes,
+p50/p95/p99 ; débit global. Les résultats sont sauvegardés en JSON et comparés à
+une référence (baseline) : toute régression au-delà de la tolérance fait échouer
+la commande (code 1), de même qu'une baseline enregistrée avec d'autres paramètres
+(sessions, langues, cible…), qu'on refuse de comparer.
+
+Sous-commande `render` : rend le content_xml de toutes les sections de la base
+avec l'ancien enchaînement de re.sub et avec render.py ; compare les temps, compte
+les balises Project Aon qui fuient dans le HTML, et vérifie les sorties de
+render.py contre des cas écrits à la main (XML -> HTML attendu : échappement,
+listes/tableaux imbriqués, notes de bas de page) puis contre quelques sections
+réelles rendues à relire (data/render_samples/, une par fichier) : un cas en
+échec, une sortie différente, une section ou un fichier manquant font échouer la
+commande (code 1).
+
+Sous-commande `entities` : débit du décodage des entités <ch.xxx/> (entities.py)
+sur tous les fichiers XML du corpus, comparé à un str.replace par entité.
+
+Sous-commande `corpus` : temps de chargement du corpus en mémoire (corpus.py),
+puis son empreinte mesurée par tracemalloc lors d'un chargement séparé.
+
+Usage :
+    python benchmark.py traffic --sessions 200 --save-baseline
+    python benchmark.py traffic --sessions 200              # compare à la baseline
+    python benchmark.py traffic --http http://127.0.0.1:8000 --concurrency 16
+    python benchmark.py render --save-samples               # réécrit les sections de référence
+    python benchmark.py render                              # cas, sections de référence, temps
+    python benchmark.py entities                            # décodage des entités <ch.xxx/>
+    python benchmark.py corpus                              # chargement et empreinte du corpus
+"""
+
+import argparse
+import atexit
+import http.client
+import http.cookies
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "data", "lonewolf.db")
+RESULTS_PATH = os.path.join(BASE_DIR, "data", "bench_results.json")
+BASELINE_PATH = os.path.join(BASE_DIR, "data", "bench_baseline.json")
+SAMPLES_DIR = os.path.join(BASE_DIR, "data", "render_samples")
+
+DEFAULT_LANGUAGE = "en"     # langue servie sans préfixe (app.DEFAULT_LANGUAGE)
+ROUTES = ("/", "/book", "/play", "/illu", "/combat/step")
+MAX_COMBAT_ROUNDS = 40
+
+_IMG_SRC = re.compile(r'<img src="((?:/[a-z]{2})?/illu/[^"]+)"')
+_STATE_JSON = re.compile(r"name=\"state_json\" value='([^']*)'")
+
+
+# ---------- Génération des sessions ----------
+
+class BookWalker:
+    """Graphe des choix et combats d'un livre, pour les marches aléatoires."""
+
+    def __init__(self, db: sqlite3.Connection, book_id: int, code: str, prefix: str = ""):
+        self.code = code
+        self.prefix = prefix    # "" (langue par défaut) ou "/es"…
+        rows = db.execute("SELECT id, sec_id FROM sections WHERE book_id=?", (book_id,)).fetchall()
+        rowid_to_sec = {r[0]: r[1] for r in rows}
+        # choix : (sec_id cible, id résolu au build) -> liens /play/…?k=id, comme les boutons du site
+        self.choices: Dict[str, List[Tuple[str, Optional[int]]]] = {}
+        for from_rowid, to_ref, to_rowid in db.execute(
+            "SELECT from_section, to_sec_ref, to_section FROM links WHERE book_id=? AND rel='choice' ORDER BY id",
+            (book_id,)
+        ):
+            sec = rowid_to_sec.get(from_rowid)
+            if sec:
+                self.choices.setdefault(sec, []).append((to_ref, to_rowid))
+        self.enemies: Dict[str, Tuple[int, int]] = {}
+        for section_id, cs, ep in db.execute(
+            """SELECT c.section_id, e.cs, e.ep FROM combats c
+               JOIN combat_enemies e ON e.combat_id = c.id
+               WHERE c.book_id=? AND e.cs IS NOT NULL AND e.ep IS NOT NULL
+               ORDER BY c.id, e.enemy_index""", (book_id,)
+        ):
+            sec = rowid_to_sec.get(section_id)
+            if sec and sec not in self.enemies:
+                self.enemies[sec] = (cs, ep)
+
+    def walk(self, rng: random.Random, max_steps: int) -> List[Tuple[str, Optional[int]]]:
+        path = [("sect1", None)]
+        while len(path) < max_steps:
+            nxt = self.choices.get(path[-1][0])
+            if not nxt:
+                break
+            path.append(rng.choice(nxt))
+        return path
+
+
+def generate_sessions(db_path: str, count: int, max_steps: int, seed: int,
+                      languages: Optional[List[str]] = None) -> List[dict]:
+    rng = random.Random(seed)
+    db = sqlite3.connect(db_path)
+    try:
+        books = db.execute("SELECT id, code, language FROM books ORDER BY language, code").fetchall()
+        walkers = [BookWalker(db, book_id, code, "" if lang == DEFAULT_LANGUAGE else f"/{lang}")
+                   for book_id, code, lang in books if not languages or lang in languages]
+    finally:
+        db.close()
+    walkers = [w for w in walkers if w.choices]
+
+    sessions = []
+    for _ in range(count):
+        w = rng.choice(walkers)
+        path = w.walk(rng, max_steps)
+        # héros tiré comme dans les règles : CS 10+[0-9], EP 20+[0-9]
+        lw_cs, lw_ep = 10 + rng.randint(0, 9), 20 + rng.randint(0, 9)
+        steps = []
+        for sec, key in path:
+            step = {"sec": sec}
+            if key is not None:
+                step["key"] = key
+            if sec in w.enemies:
+                step["combat"] = w.enemies[sec]
+            steps.append(step)
+        sessions.append({"book": w.code, "prefix": w.prefix, "lw_cs": lw_cs, "lw_ep": lw_ep, "steps": steps})
+    return sessions
+
+
+# ---------- Transports ----------
+
+class FlaskTransport:
+    def __init__(self):
+        # lecteurs et hits fictifs : progression et popularité dans des bases jetables,
+        # jamais dans data/progress.db / data/popularity.db (qui décident du préchargement)
+        if "app" in sys.modules:
+            raise RuntimeError("app.py déjà importé : les bases de progression/popularité ne peuvent plus être redirigées")
+        scratch = tempfile.mkdtemp(prefix="lonewolf-bench-")
+        atexit.register(shutil.rmtree, scratch, ignore_errors=True)
+        os.environ["LONEWOLF_PROGRESS_DB"] = os.path.join(scratch, "progress.db")
+        os.environ["LONEWOLF_POPULARITY_DB"] = os.path.join(scratch, "popularity.db")
+        from app import app
+        self.app = app
+
+    def session(self) -> "FlaskSession":
+        return FlaskSession(self.app.test_client())
+
+
+class FlaskSession:
+    """Un lecteur : le client de test garde ses cookies."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method: str, path: str, form: Optional[dict] = None) -> Tuple[int, str]:
+        resp = self.client.open(path, method=method, data=form)
+        try:
+            if resp.mimetype.startswith("text/"):
+                return resp.status_code, resp.get_data(as_text=True)
+            resp.get_data()
+            return resp.status_code, ""
+        finally:
+            resp.close()
+
+
+class HttpTransport:
+    def __init__(self, base_url: str):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self._local = threading.local()
+
+    def session(self) -> "HttpSession":
+        return HttpSession(self)
+
+    def connection(self, reset: bool = False) -> http.client.HTTPConnection:
+        """Connexion keep-alive du thread courant."""
+        conn = getattr(self._local, "conn", None)
+        if reset and conn is not None:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return conn
+
+
+class HttpSession:
+    """Un lecteur : cookies reçus renvoyés aux requêtes suivantes (comme un navigateur)."""
+
+    def __init__(self, transport: HttpTransport):
+        self.transport = transport
+        self.cookies: Dict[str, str] = {}
+
+    def request(self, method: str, path: str, form: Optional[dict] = None) -> Tuple[int, str]:
+        headers = {}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        conn = self.transport.connection()
+        for attempt in (0, 1):
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                raw = resp.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # connexion keep-alive fermée par le serveur : un nouvel essai
+                if attempt:
+                    self.transport.connection(reset=True)
+                    raise
+                conn = self.transport.connection(reset=True)
+        for header in resp.headers.get_all("Set-Cookie") or ():
+            jar = http.cookies.SimpleCookie()
+            jar.load(header)
+            self.cookies.update((k, m.value) for k, m in jar.items())
+        ctype = resp.getheader("Content-Type", "")
+        return resp.status, raw.decode("utf-8", "replace") if ctype.startswith("text/") else ""
+
+
+# ---------- Rejeu ----------
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {r: [] for r in ROUTES}
+        self.errors: Dict[str, int] = {r: 0 for r in ROUTES}
+
+    def timed(self, client, route: str, method: str, path: str, form: Optional[dict] = None) -> str:
+        t0 = time.perf_counter()
+        try:
+            status, body = client.request(method, path, form)
+        except Exception:
+            status, body = 0, ""
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            self.samples[route].append(elapsed)
+            if status != 200:
+                self.errors[route] += 1
+        return body
+
+
+def replay_session(transport, rec: Recorder, session: dict, think: float = 0.0) -> None:
+    code, prefix = session["book"], session.get("prefix", "")
+    client = transport.session()    # un lecteur par session
+    rec.timed(client, "/", "GET", prefix + "/")
+    rec.timed(client, "/book", "GET", f"{prefix}/book/{code}")
+    for step in session["steps"]:
+        if think:
+            time.sleep(think)   # temps de lecture avant le clic
+        query = f"?k={step['key']}" if "key" in step else ""
+        html = rec.timed(client, "/play", "GET", f"{prefix}/play/{code}/{step['sec']}{query}")
+        for src in _IMG_SRC.findall(html):
+            rec.timed(client, "/illu", "GET", src)
+
+        if "combat" in step:
+            en_cs, en_ep = step["combat"]
+            url = f"{prefix}/combat/step/{code}/{step['sec']}"
+            html = rec.timed(client, "/combat/step", "POST", url, {
+                "action": "start", "lw_cs": session["lw_cs"], "lw_ep": session["lw_ep"],
+                "enemy_cs": en_cs, "enemy_ep": en_ep,
+            })
+            for _ in range(MAX_COMBAT_ROUNDS):
+                m = _STATE_JSON.search(html)
+                if not m:
+                    break  # combat terminé
+                html = rec.timed(client, "/combat/step", "POST", url, {"action": "next", "state_json": m.group(1)})
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(rec: Recorder, wall: float) -> dict:
+    routes = {}
+    total = 0
+    for route in ROUTES:
+        values = sorted(rec.samples[route])
+        total += len(values)
+        if not values:
+            continue
+        routes[route] = {
+            "requests": len(values),
+            "errors": rec.errors[route],
+            "mean_ms": sum(values) / len(values) * 1000,
+            "p50_ms": _percentile(values, 50) * 1000,
+            "p95_ms": _percentile(values, 95) * 1000,
+            "p99_ms": _percentile(values, 99) * 1000,
+        }
+    return {"wall_seconds": wall, "requests": total, "throughput_rps": total / wall if wall else 0.0, "routes": routes}
+
+
+# paramètres qui changent le trafic rejoué : une baseline n'est comparable qu'à paramètres égaux
+COMPARABLE_META = ("target", "sessions", "steps", "seed", "languages", "concurrency", "think_ms", "memory_mode")
+
+
+def meta_mismatch(results: dict, baseline: dict) -> List[str]:
+    cur, base = results.get("meta", {}), baseline.get("meta", {})
+    return [f"{key}: {cur.get(key)!r} (baseline {base.get(key)!r})"
+            for key in COMPARABLE_META if cur.get(key) != base.get(key)]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Régressions : p95 plus lent par route ou débit global plus faible que la baseline au-delà de la tolérance."""
+    problems = []
+    if results["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        problems.append(f"débit {results['throughput_rps']:.0f} req/s < baseline {baseline['throughput_rps']:.0f} req/s")
+    for route, base in baseline.get("routes", {}).items():
+        cur = results["routes"].get(route)
+        if cur is None:
+            continue
+        if cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{route}: p95 {cur['p95_ms']:.2f} ms > baseline {base['p95_ms']:.2f} ms")
+        if cur["errors"] > base.get("errors", 0):
+            problems.append(f"{route}: {cur['errors']} erreurs (baseline {base.get('errors', 0)})")
+    return problems
+
+
+def print_report(results: dict) -> None:
+    print(f"{'route':<14}{'req':>8}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route in ROUTES:
+        r = results["routes"].get(route)
+        if r:
+            print(f"{route:<14}{r['requests']:>8}{r['errors']:>6}"
+                  f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+    print(f"total : {results['requests']} requêtes en {results['wall_seconds']:.2f} s "
+          f"→ {results['throughput_rps']:.0f} req/s")
+
+
+def cmd_traffic(args) -> int:
+    sessions = generate_sessions(args.db, args.sessions, args.steps, args.seed, args.lang)
+    transport = HttpTransport(args.http) if args.http else FlaskTransport()
+    think = args.think / 1000.0
+
+    # échauffement (templates, index des images, caches) hors mesure
+    warm = Recorder()
+    for s in sessions[: min(5, len(sessions))]:
+        replay_session(transport, warm, s)
+
+    rec = Recorder()
+    t0 = time.perf_counter()
+    if args.concurrency > 1:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(lambda s: replay_session(transport, rec, s, think), sessions))
+    else:
+        for s in sessions:
+            replay_session(transport, rec, s, think)
+    wall = time.perf_counter() - t0
+
+    results = summarize(rec, wall)
+    results["meta"] = {
+        "target": args.http or "flask-test-client",
+        "sessions": args.sessions, "steps": args.steps, "seed": args.seed,
+        "languages": sorted(set(args.lang)) if args.lang else "all",
+        "concurrency": args.concurrency, "think_ms": args.think,
+        "memory_mode": os.environ.get("LONEWOLF_MEMORY", "0") == "1",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    print_report(results)
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Résultats : {args.out}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline enregistrée : {args.baseline}")
+        return 0
+
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        mismatch = meta_mismatch(results, baseline)
+        if mismatch:
+            print("\n*** BASELINE NON COMPARABLE : paramètres différents ***", file=sys.stderr)
+            for m in mismatch:
+                print(f"  - {m}", file=sys.stderr)
+            print("Relancer avec les mêmes paramètres, ou enregistrer une nouvelle baseline (--save-baseline).",
+                  file=sys.stderr)
+            return 1
+        problems = compare(results, baseline, args.tolerance)
+        if problems:
+            print("\n*** RÉGRESSION DE PERFORMANCE ***", file=sys.stderr)
+            for p in problems:
+                print(f"  - {p}", file=sys.stderr)
+            return 1
+        print(f"OK : pas de régression (tolérance {args.tolerance:.0%}) par rapport à {args.baseline}")
+    else:
+        print(f"(pas de baseline : {args.baseline} — utilisez --save-baseline)")
+    return 0
+
+
+# ---------- Rendu du content_xml ----------
+
+def legacy_render_content_xml(xml: str) -> str:
+    """Ancien rendu de app.py (un re.sub par balise), gardé comme point de comparaison."""
+    if not xml:
+        return ""
+    replacements = {
+        "<ch.apos/>": "'",
+        "<ch.ndash/>": "-",
+        "<ch.mdash/>": "—",
+        "<ch.hellip/>": "…",
+        "<ch.amp/>": "&",
+    }
+    for k, v in replacements.items():
+        xml = xml.replace(k, v)
+    xml = re.sub(r"</?para>", "", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"<emphasis>", "<em>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"</emphasis>", "</em>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"<strong>", "<strong>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"</strong>", "</strong>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"<list>", "<ul>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"</list>", "</ul>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"<item>", "<li>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"</item>", "</li>", xml, flags=re.IGNORECASE)
+    xml = re.sub(r"<choice\b.*?>.*?</choice>", "", xml, flags=re.IGNORECASE | re.DOTALL)
+    xml = re.sub(r"<illustration\b.*?>.*?</illustration>", "", xml, flags=re.IGNORECASE | re.DOTALL)
+    parts = [p.strip() for p in re.split(r"\n\s*\n", xml) if p.strip()]
+    return "".join(f"<p>{p}</p>" for p in parts) if parts else xml
+
+
+_HTML_TAGS = frozenset(
+    "a b br cite dd div dl dt em figure i img li ol p q span strong sup table caption td th tr ul "
+    "blockquote h3".split()
+)
+_OUT_TAG = re.compile(r"</?([A-Za-z][\w.:\-]*)")
+
+
+def leaked_tags(html: str) -> int:
+    """Balises non HTML restées dans la sortie (balisage Project Aon non traduit)."""
+    return sum(1 for m in _OUT_TAG.finditer(html) if m.group(1).lower() not in _HTML_TAGS)
+
+
+# Cas écrits à la main : (nom, content_xml, HTML attendu). Ils disent ce que la sortie doit
+# être (échappement, imbrication, notes) ; les sections de référence couvrent le balisage réel.
+RENDER_CASES = (
+    ("texte brut échappé",
+     'Fish & chips\n\n"two"',
+     '<p>Fish &amp; chips</p><p>"two"</p>'),
+    ("< et & isolés échappés",
+     "<p>a < b & c</p>",
+     "<p>a &lt; b &amp; c</p>"),
+    ("références conservées, pas de balise injectée",
+     "<p>&lt;script&gt;alert(1)&lt;/script&gt;</p>",
+     "<p>&lt;script&gt;alert(1)&lt;/script&gt;</p>"),
+    ("idref piégé : pas de lien",
+     '<p><a idref="sect1&quot; onmouseover=&quot;x">go</a></p>',
+     '<p><span class="ref">go</span></p>'),
+    ("renvoi vers une section",
+     '<p>Turn to <a idref="sect12">12</a>.</p>',
+     '<p>Turn to <a href="/play/_/sect12">12</a>.</p>'),
+    ("entité caractère",
+     "<p>Tom &amp; Jerry<ch.endash/>fin</p>",
+     "<p>Tom &amp; Jerry–fin</p>"),
+    ("listes imbriquées",
+     "<ul><li>One<ul><li>A</li><li>B</li></ul></li><li>Two</li></ul>",
+     "<ul><li>One<ul><li>A</li><li>B</li></ul></li><li>Two</li></ul>"),
+    ("tableau dans une liste, liste dans le tableau",
+     "<ol><li>a<table><tr><td><ol><li>deep</li></ol></td></tr></table></li></ol>",
+     '<ol><li>a<table class="aon-table"><tr><td><ol><li>deep</li></ol></td></tr></table></li></ol>'),
+    ("balises non fermées refermées",
+     "<ul><li>open",
+     "<ul><li>open</li></ul>"),
+    ("choix retirés du texte",
+     '<choice idref="sect85">If you wish, <link-text>turn to 85</link-text>.</choice>',
+     ""),
+    ("appels et notes de bas de page",
+     '<p>A<footref id="f1" idref="n1"/> B<footref id="f2" idref="n2"/></p>'
+     '<footnotes><footnote id="n1" idref="f1"><p>one</p></footnote>'
+     '<footnote id="n2" idref="f2"><p>two <ul><li>x</li></ul></p></footnote></footnotes>',
+     '<p>A<sup class="footref"><a id="f1" href="#n1">1</a></sup> B<sup class="footref"><a id="f2" href="#n2">2</a></sup></p>'
+     '<ol class="footnotes"><li id="n1"><p>one</p> <a class="footnote-back" href="#f1">↩</a></li>'
+     '<li id="n2"><p>two <ul><li>x</li></ul></p> <a class="footnote-back" href="#f2">↩</a></li></ol>'),
+)
+
+
+def check_render_cases(render) -> List[str]:
+    """Noms des cas écrits à la main dont la sortie diffère de l'attendu (détail sur stderr)."""
+    failed = []
+    for name, xml, expected in RENDER_CASES:
+        got = render(xml)
+        if got != expected:
+            failed.append(name)
+            print(f"  - {name}\n      attendu : {expected!r}\n      obtenu  : {got!r}", file=sys.stderr)
+    return failed
+
+
+# Sections réelles dont le rendu est relu et versionné (data/render_samples/<langue>_<code>_<section>.html)
+RENDER_SAMPLES = (
+    "en/10tdot/title",      # notes de bas de page
+    "es/03lcdk/title",
+    "en/22tbos/sect156",    # tableau
+    "es/16eldv/sect235",
+    "en/02smr/sect23",      # listes imbriquées
+    "en/01fftd/sect315",    # illustration
+    "es/01hdlo/sect276",
+    "en/02fotw/sect158",    # combat
+    "es/04eam/sect90",
+    "en/02fotw/sect310",    # panneau (signpost)
+    "en/10tdot/sect307",    # citation
+    "en/03btng/sect29",     # bloc cité
+    "en/01fftd/sect301",    # choix retirés du texte
+    "en/06tkot/sect218",    # fin (deadend)
+)
+
+_BLOCK_END = re.compile(r"(</(?:p|li|tr|table|ul|ol|blockquote|div|dl|h3)>)(?![ \t]*\n)")
+
+
+def readable(html: str) -> str:
+    """Sortie découpée après chaque bloc (sauf fin de ligne déjà présente) : fichiers lisibles, diffs courts."""
+    return _BLOCK_END.sub(r"\1\n", html).rstrip("\n") + "\n"
+
+
+def sample_path(directory: str, key: str) -> str:
+    return os.path.join(directory, key.replace("/", "_") + ".html")
+
+
+def check_render_samples(render, sections: Dict[str, str], directory: str, save: bool) -> List[str]:
+    """Sections de référence en échec (absentes de la base, sans fichier ou rendu différent)."""
+    import difflib
+
+    failed = []
+    for key in RENDER_SAMPLES:
+        if key not in sections:
+            failed.append(key)
+            print(f"  - {key} : section absente de la base", file=sys.stderr)
+            continue
+        got = readable(render(sections[key]))
+        path = sample_path(directory, key)
+        if save:
+            os.makedirs(directory, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(got)
+            continue
+        if not os.path.isfile(path):
+            failed.append(key)
+            print(f"  - {key} : {path} introuvable (à créer avec --save-samples)", file=sys.stderr)
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            expected = f.read()
+        if got != expected:
+            failed.append(key)
+            diff = difflib.unified_diff(expected.splitlines(), got.splitlines(), "attendu", "obtenu", lineterm="")
+            print(f"  - {key} :\n" + "\n".join(f"      {line}" for line in list(diff)[:20]), file=sys.stderr)
+    return failed
+
+
+def cmd_render(args) -> int:
+    from render import render_section
+
+    db = sqlite3.connect(args.db)
+    try:
+        rows = db.execute(
+            "SELECT b.language, b.code, s.sec_id, s.content_xml FROM sections s JOIN books b ON b.id = s.book_id "
+            "ORDER BY b.language, b.code, s.id"
+        ).fetchall()
+    finally:
+        db.close()
+    total_bytes = sum(len(r[3] or "") for r in rows)
+
+    def current(xml):
+        return render_section(xml, section_url=lambda ref: "/play/_/" + ref,
+                              illustration_url=lambda src: "/illu/_/" + src)
+
+    failed = check_render_cases(current)
+    if failed:
+        print(f"\n*** {len(failed)}/{len(RENDER_CASES)} CAS DE RENDU EN ÉCHEC ***", file=sys.stderr)
+        return 1
+    print(f"Cas écrits à la main : {len(RENDER_CASES)} OK")
+
+    sections = {f"{lang}/{code}/{sec}": xml or "" for lang, code, sec, xml in rows}
+    failed = check_render_samples(current, sections, args.samples, args.save_samples)
+    if args.save_samples:
+        print(f"Sections de référence enregistrées : {args.samples} ({len(RENDER_SAMPLES) - len(failed)} fichiers)")
+    if failed:
+        print(f"\n*** {len(failed)}/{len(RENDER_SAMPLES)} SECTIONS DE RÉFÉRENCE EN ÉCHEC ***", file=sys.stderr)
+        return 1
+    if not args.save_samples:
+        print(f"Sections de référence : {len(RENDER_SAMPLES)} OK")
+
+    print(f"{len(rows)} sections, {total_bytes / 1e6:.1f} Mo de XML, meilleur temps sur {args.repeat} passes")
+    print(f"{'rendu':<10}{'total ms':>10}{'µs/section':>12}{'Mo/s':>8}{'fuites':>10}")
+    timings = {}
+    for name, fn in (("legacy", legacy_render_content_xml), ("render.py", current)):
+        best = float("inf")
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            out = [fn(r[3]) for r in rows]
+            best = min(best, time.perf_counter() - t0)
+        leaks = sum(1 for html in out if leaked_tags(html))
+        timings[name] = best
+        print(f"{name:<10}{best * 1000:>10.1f}{best / len(rows) * 1e6:>12.1f}"
+              f"{total_bytes / best / 1e6:>8.1f}{leaks:>10}")
+    print(f"accélération : ×{timings['legacy'] / timings['render.py']:.2f}  "
+          f"(fuites = sections contenant encore des balises non HTML)")
+    return 0
+
+
+# ---------- Décodage des entités ----------
+
+def cmd_entities(args) -> int:
+    from glob import glob
+    from entities import ENTITIES, decode_entities
+
+    paths = sorted(glob(os.path.join(args.source, "*", "xml", "*.xml")))
+    texts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            texts.append(f.read())
+    total_bytes = sum(len(t) for t in texts)
+    found = sum(t.count("<ch.") for t in texts)
+
+    def replace_each(text):
+        for name, value in ENTITIES.items():
+            text = text.replace(f"<ch.{name}/>", value)
+        return text
+
+    print(f"{len(texts)} fichiers, {total_bytes / 1e6:.1f} Mo, {found} entités, "
+          f"table de {len(ENTITIES)} entrées ; meilleur temps sur {args.repeat} passes")
+    print(f"{'décodeur':<16}{'total ms':>10}{'Mo/s':>8}{'restantes':>11}")
+    timings = {}
+    for name, fn in (("str.replace ×N", replace_each), ("entities.py", decode_entities)):
+        best = float("inf")
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            out = [fn(t) for t in texts]
+            best = min(best, time.perf_counter() - t0)
+        left = sum(t.count("<ch.") for t in out)
+        timings[name] = best
+        print(f"{name:<16}{best * 1000:>10.1f}{total_bytes / best / 1e6:>8.1f}{left:>11}")
+    print(f"accélération : ×{timings['str.replace ×N'] / timings['entities.py']:.2f}")
+    return 0
+
+
+# ---------- Corpus en mémoire ----------
+
+def cmd_corpus(args) -> int:
+    from corpus import Corpus
+
+    best = float("inf")
+    for _ in range(args.repeat):
+        corpus = Corpus.load(args.db)
+        best = min(best, corpus.stats["load_seconds"])
+    st = Corpus.load(args.db, measure=True).stats
+    langs = ", ".join(f"{lang} {len(books)}" for lang, books in sorted(corpus.by_language.items()))
+    print(f"{st['books']} livres ({langs}), {st['sections']} sections, {st['choices']} choix, "
+          f"{st['images']} illustrations")
+    print(f"chargement : {best:.2f} s (meilleur de {args.repeat}) ; "
+          f"empreinte : {st['bytes'] / 1e6:.1f} Mo (tracemalloc, chargement mesuré : {st['load_seconds']:.2f} s)")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Banc d'essai du site Lone Wolf.")
+    parser.add_argument("--db", default=DB_PATH, help="base SQLite utilisée pour générer les sessions")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("traffic", help="rejoue des sessions de lecture réalistes")
+    p.add_argument("--sessions", type=int, default=100)
+    p.add_argument("--steps", type=int, default=30, help="nombre max. de sections par session")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--lang", action="append", help="langue(s) des livres joués (défaut : toutes), ex. --lang en")
+    p.add_argument("--http", help="URL d'un serveur à tester (sinon client de test Flask)")
+    p.add_argument("--concurrency", type=int, default=1)
+    p.add_argument("--think", type=float, default=0.0,
+                   help="temps de lecture (ms) avant chaque section ; 0 = sessions enchaînées sans pause")
+    p.add_argument("--out", default=RESULTS_PATH)
+    p.add_argument("--baseline", default=BASELINE_PATH)
+    p.add_argument("--tolerance", type=float, default=0.25, help="écart toléré vs baseline (0.25 = 25 %%)")
+    p.add_argument("--save-baseline", action="store_true", help="enregistre ces résultats comme baseline")
+    p.set_defaults(func=cmd_traffic)
+
+    p = sub.add_parser("render", help="compare l'ancien rendu du content_xml et render.py")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--samples", default=SAMPLES_DIR, help="dossier des sections de référence")
+    p.add_argument("--save-samples", action="store_true",
+                   help="réécrit les sections de référence avec le rendu actuel (à relire avant commit)")
+    p.set_defaults(func=cmd_render)
+
+    p = sub.add_parser("entities", help="débit du décodage des entités <ch.xxx/> sur le corpus")
+    p.add_argument("--source", default=os.path.join(BASE_DIR, "project-aon-master"))
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=cmd_entities)
+
+    p = sub.add_parser("corpus", help="temps de chargement et empreinte du corpus en mémoire")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=cmd_corpus)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
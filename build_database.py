@@ -7,8 +7,14 @@ build_aon_fs.py
 Construit une base SQLite pour Lone Wolf (Project Aon) à partir d'un dossier
 décompressé, sans arguments.
 
-- Dossier source (XML) : ./project-aon-master
+- Dossier source (XML) : ./project-aon-master/<langue>/xml (toutes les langues livrées)
 - Base SQLite : ./data/lonewolf.db
+- Un livre est identifié par (langue, code) ; langue = dossier de l'arborescence (en, es…)
+- Les arborescences sont analysées en parallèle (un processus par langue), les
+  écritures SQLite restent dans le processus principal
+- Chaque lien est résolu vers la ligne de sa section cible (links.to_section) et le
+  graphe des choix de chaque livre est contrôlé (table book_integrity) : un choix sans
+  cible arrête le build avant toute écriture
 
 Usage :
     python build_aon_fs.py
@@ -19,15 +25,21 @@ import re
 import sqlite3
 import sys
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from typing import Dict, List, Optional, Tuple
 
+from entities import decode_entities
+
 # ----- Chemins -----
 SOURCE_ROOT = r"./project-aon-master"      # dossier déjà UNZIP
 DB_PATH     = r"./data/lonewolf.db"        # base à créer
 
-LANG_FILTER_PREFIX = "en"   # ne prend que les XML en anglais
+LANGUAGES = ()              # vide = toutes les langues ayant un dossier xml/ ; exemple: ("en", "es")
 ONLY_CODES = set()          # exemple: {"01fftd", "02fotw"}
+IMAGE_FORMATS = ("jpeg", "png", "gif")
+ALLOW_DANGLING = set()      # livres importés malgré des choix sans cible, exemple: {"es/05eddls"}
 
 # ---------- Utilitaires parsing ----------
 
@@ -37,6 +49,7 @@ _META_BLOCK = re.compile(r"<meta>(.*?)</meta>", re.DOTALL | re.IGNORECASE)
 _META_TITLE = re.compile(r"<title>(.*?)</title>", re.DOTALL | re.IGNORECASE)
 _META_LINK = re.compile(r'<link\s+class="([^"]+)"\s+idref="([^"]+)"\s*/?>', re.IGNORECASE)
 _DATA_BLOCK = re.compile(r"<data>(.*?)</data>", re.DOTALL | re.IGNORECASE)
+_FOOTNOTES_BLOCK = re.compile(r"<footnotes>.*?</footnotes>", re.DOTALL | re.IGNORECASE)
 _CHOICE = re.compile(r'<choice\s+idref="([^"]+)"[^>]*>(.*?)</choice>', re.DOTALL | re.IGNORECASE)
 _LINK_TEXT = re.compile(r"<link-text>(.*?)</link-text>", re.DOTALL | re.IGNORECASE)
 _ILLUSTRATION = re.compile(r"<illustration[^>]*>(.*?)</illustration>", re.DOTALL | re.IGNORECASE)
@@ -51,23 +64,7 @@ _BLURB_BLOCK = re.compile(r'<([a-zA-Z0-9:_-]+)[^>]*\bclass="[^"]*\bblurb\b[^"]*"
 _COMBAT_BLOCK = re.compile(r"<combat\b[^>]*>(.*?)</combat>", re.IGNORECASE | re.DOTALL)
 _ENEMY_NAME = re.compile(r"<enemy>(.*?)</enemy>", re.IGNORECASE | re.DOTALL)
 _ENEMY_ATTR = re.compile(r'<enemy-attribute[^>]*\bclass="([^"]+)"[^>]*>(.*?)</enemy-attribute>', re.IGNORECASE | re.DOTALL)
-
-
-ENTITY_MAP = {
-    "<ch.apos/>": "'",
-    "<ch.ndash/>": "-",
-    "<ch.mdash/>": "—",
-    "<ch.hellip/>": "…",
-    "<ch.amp/>": "&",
-    # ajoute ici d’autres entités Project Aon si besoin
-}
-
-def clean_entities(text: str) -> str:
-    if not text:
-        return text
-    for k, v in ENTITY_MAP.items():
-        text = text.replace(k, v)
-    return text
+_IDREF = re.compile(r'\bidref="([^"]+)"', re.IGNORECASE)
 
 
 def _balance_section_block(xml: str, start_tag_pos: int) -> Tuple[int, int]:
@@ -209,12 +206,12 @@ def read_text_file(path: str) -> str:
 
 
 def parse_book_from_file(xml_path: str) -> Dict:
-    raw = read_text_file(xml_path)
+    # entités <ch.xxx/> décodées une fois pour tout le fichier (titres, choix, contenu, synopsis)
+    raw = decode_entities(read_text_file(xml_path))
 
     # Titre / code / langue
     mt = _GAMEBOOK_TITLE.search(raw)
     book_title = mt.group(1).strip() if mt else os.path.basename(xml_path)
-    book_title = clean_entities(book_title)
 
     code = os.path.splitext(os.path.basename(xml_path))[0].lower()
     mlang = _XML_LANG.search(raw)
@@ -242,11 +239,13 @@ def parse_book_from_file(xml_path: str) -> Dict:
 
         # Meta & titre de section
         sec_title, meta_links, _meta_raw = extract_meta(block)
-        sec_title = clean_entities(sec_title)
 
         # Corps + choix + illustrations + combats (⚠ extract_data doit renvoyer 4 valeurs)
         data_xml, choices, imgs, cmbs = extract_data(block)
-        data_xml = clean_entities(data_xml)
+        # Notes de bas de page (hors <data>) : ajoutées à la fin, rendues sous le texte
+        mfoot = _FOOTNOTES_BLOCK.search(block)
+        if mfoot:
+            data_xml = data_xml.rstrip() + "\n" + mfoot.group(0)
 
         # Classe de section
         mclass = _SECTION_CLASS.search(block)
@@ -312,11 +311,12 @@ PRAGMA foreign_keys = ON;
 
 CREATE TABLE IF NOT EXISTS books (
     id        INTEGER PRIMARY KEY AUTOINCREMENT,
-    code      TEXT NOT NULL UNIQUE,
+    code      TEXT NOT NULL,
     title     TEXT NOT NULL,
-    language  TEXT NOT NULL,
+    language  TEXT NOT NULL,          -- dossier de langue (en, es…)
     category  TEXT,
-    synopsis  TEXT
+    synopsis  TEXT,
+    UNIQUE(language, code)            -- index (language, code) : requêtes du site
 );
 
 
@@ -336,6 +336,7 @@ CREATE TABLE IF NOT EXISTS links (
     book_id        INTEGER NOT NULL REFERENCES books(id) ON DELETE CASCADE,
     from_section   INTEGER NOT NULL REFERENCES sections(id) ON DELETE CASCADE,
     to_sec_ref     TEXT NOT NULL,
+    to_section     INTEGER REFERENCES sections(id) ON DELETE SET NULL,   -- cible résolue, NULL si absente
     rel            TEXT NOT NULL,
     display_text   TEXT,
     raw_xml        TEXT
@@ -373,15 +374,62 @@ CREATE TABLE IF NOT EXISTS combat_enemies (
 );
 
 
+-- Contrôle du graphe des choix, un rapport par livre (voir check_integrity)
+CREATE TABLE IF NOT EXISTS book_integrity (
+    book_id     INTEGER PRIMARY KEY REFERENCES books(id) ON DELETE CASCADE,
+    sections    INTEGER NOT NULL,
+    choices     INTEGER NOT NULL,
+    dangling    INTEGER NOT NULL,     -- choix vers une section absente (ou référence mal formée)
+    duplicates  INTEGER NOT NULL,     -- même cible proposée plusieurs fois par une section
+    orphans     INTEGER NOT NULL,     -- sections numérotées qu'aucun lien n'atteint
+    report_json TEXT NOT NULL         -- détail : {"dangling": [[de, vers]], "duplicates": [...], "orphans": [...]}
+);
+
+
+-- Métadonnées du build (build_version : change à chaque génération, surveillé par app.py)
+CREATE TABLE IF NOT EXISTS build_info (
+    key    TEXT PRIMARY KEY,
+    value  TEXT
+);
+
+
 CREATE INDEX IF NOT EXISTS idx_sections_book_sec ON sections(book_id, sec_id);
 CREATE INDEX IF NOT EXISTS idx_links_from ON links(book_id, from_section);
 CREATE INDEX IF NOT EXISTS idx_links_to   ON links(book_id, to_sec_ref);
+CREATE INDEX IF NOT EXISTS idx_links_to_section ON links(to_section);
 CREATE INDEX IF NOT EXISTS idx_images_section ON images(section_id);
 CREATE INDEX IF NOT EXISTS idx_combats_section ON combats(section_id);
 CREATE INDEX IF NOT EXISTS idx_cenemies_combat ON combat_enemies(combat_id);
 """
 
+DATA_TABLES = ("book_integrity", "combat_enemies", "combats", "images", "links", "sections", "books")
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+def _has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    return any(c[1] == column for c in conn.execute(f"PRAGMA table_info({table})"))
+
+def _has_language_key(conn: sqlite3.Connection) -> bool:
+    """Vrai si books n'existe pas encore ou est déjà unique sur (language, code)."""
+    if not _table_exists(conn, "books"):
+        return True
+    for idx in conn.execute("PRAGMA index_list(books)").fetchall():
+        if idx[2]:   # unique
+            cols = [c[2] for c in conn.execute(f"PRAGMA index_info('{idx[1]}')")]
+            if cols == ["language", "code"]:
+                return True
+    return False
+
 def init_db(conn: sqlite3.Connection) -> None:
+    if not _has_language_key(conn):
+        # ancienne base (livres uniques par code seul) : la base est régénérable, on repart de zéro
+        print("[INFO] Ancien schéma (books.code unique) : tables de contenu recréées")
+        for table in DATA_TABLES:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+    elif _table_exists(conn, "links") and not _has_column(conn, "links", "to_section"):
+        # liens d'un build précédent : la colonne est remplie à la réimportation des livres
+        conn.execute("ALTER TABLE links ADD COLUMN to_section INTEGER REFERENCES sections(id) ON DELETE SET NULL")
     conn.executescript(SCHEMA_SQL)
     conn.commit()
 
@@ -390,15 +438,14 @@ def upsert_book(conn: sqlite3.Connection, code: str, title: str, language: str,
     cur.execute(
         """INSERT INTO books(code, title, language, category, synopsis)
            VALUES (?, ?, ?, ?, ?)
-           ON CONFLICT(code) DO UPDATE
+           ON CONFLICT(language, code) DO UPDATE
            SET title=excluded.title,
-               language=excluded.language,
                category=excluded.category,
                synopsis=COALESCE(excluded.synopsis, books.synopsis)""",
         (code, title, language, category, synopsis)
     )
     conn.commit()
-    cur.execute("SELECT id FROM books WHERE code = ?", (code,))
+    cur.execute("SELECT id FROM books WHERE language = ? AND code = ?", (language, code))
     return cur.fetchone()[0]
 
 
@@ -421,9 +468,9 @@ def insert_sections_links_images(conn: sqlite3.Connection, book_id: int, book: D
         if not from_rowid:
             continue
         cur.execute(
-            "INSERT INTO links(book_id, from_section, to_sec_ref, rel, display_text, raw_xml) "
-            "VALUES (?, ?, ?, ?, ?, ?)",
-            (book_id, from_rowid, l["to"], l["rel"], l["display"], l["raw"])
+            "INSERT INTO links(book_id, from_section, to_sec_ref, to_section, rel, display_text, raw_xml) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (book_id, from_rowid, l["to"], sec_id_to_rowid.get(l["to"]), l["rel"], l["display"], l["raw"])
         )
 
     for im in book["images"]:
@@ -440,16 +487,27 @@ def insert_sections_links_images(conn: sqlite3.Connection, book_id: int, book: D
 
     conn.commit()
 
-def find_category_from_cover(code: str) -> str:
+def _image_categories(lang: str, fmt: str) -> List[str]:
+    root = os.path.join(SOURCE_ROOT, lang, fmt)
+    if not os.path.isdir(root):
+        return []
+    return sorted(c for c in os.listdir(root) if c != "misc" and os.path.isdir(os.path.join(root, c)))
+
+def find_category_from_cover(lang: str, code: str) -> str:
     """
-    Cherche dans en/jpeg/<cat>/<code>/skins/ebook/cover.* pour trouver la catégorie.
+    Cherche dans <lang>/jpeg/<cat>/<code>/skins/ebook/cover.* pour trouver la catégorie ;
+    à défaut (pas de couverture, ex. es/), le dossier d'images <lang>/{jpeg,png,gif}/<cat>/<code>.
     """
-    jpeg_root = os.path.join(SOURCE_ROOT, "en", "jpeg")
-    for cat in ("lw", "gs", "fw"):
+    jpeg_root = os.path.join(SOURCE_ROOT, lang, "jpeg")
+    for cat in _image_categories(lang, "jpeg"):
         base = os.path.join(jpeg_root, cat, code, "skins", "ebook")
         for filename in ("cover.jpg", "cover.jpeg", "cover.png"):
             if os.path.isfile(os.path.join(base, filename)):
                 return cat
+    for fmt in IMAGE_FORMATS:
+        for cat in _image_categories(lang, fmt):
+            if os.path.isdir(os.path.join(SOURCE_ROOT, lang, fmt, cat, code)):
+                return cat
     return "fw"
 
 def _clean_snippet(text: str, max_len: int = 900) -> str:
@@ -496,44 +554,132 @@ def insert_combats(conn: sqlite3.Connection, book_id: int, book: Dict, sec_id_to
     conn.commit()
 
 
+def check_integrity(book: Dict) -> Dict:
+    """
+    Contrôle le graphe des choix d'un livre analysé (avant écriture) :
+    - dangling   : choix dont la cible n'est pas une section du livre ;
+    - duplicates : choix répétant une cible déjà proposée par la même section ;
+    - orphans    : sections numérotées (hors sect1) qu'aucun choix ni renvoi du texte n'atteint.
+    Les liens méta (prev/next…) visent aussi des sections liminaires non importées : ignorés.
+    """
+    known = {s["id"] for s in book["sections"]}
+    dangling, duplicates, seen = [], [], set()
+    choices = 0
+    for l in book["links"]:
+        if l["rel"] != "choice":
+            continue
+        choices += 1
+        pair = (l["from"], l["to"])
+        if l["to"] not in known:
+            dangling.append(list(pair))
+        elif pair in seen:
+            duplicates.append(list(pair))
+        seen.add(pair)
+
+    # le contenu contient aussi les <choice idref=…> : un seul balayage suffit
+    referenced = set()
+    for s in book["sections"]:
+        referenced.update(ref for ref in _IDREF.findall(s["content"]) if ref != s["id"])
+    orphans = [s["id"] for s in book["sections"]
+               if s["id"].startswith("sect") and s["id"] != "sect1" and s["id"] not in referenced]
+
+    return {"sections": len(book["sections"]), "choices": choices,
+            "dangling": dangling, "duplicates": duplicates, "orphans": orphans}
+
+def insert_integrity(conn: sqlite3.Connection, book_id: int, report: Dict) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO book_integrity(book_id, sections, choices, dangling, duplicates, orphans, report_json) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (book_id, report["sections"], report["choices"], len(report["dangling"]), len(report["duplicates"]),
+         len(report["orphans"]),
+         json.dumps({k: report[k] for k in ("dangling", "duplicates", "orphans")}))
+    )
+    conn.commit()
+
+
+def write_build_version(conn: sqlite3.Connection) -> str:
+    version = str(time.time_ns())
+    conn.execute(
+        "INSERT INTO build_info(key, value) VALUES ('build_version', ?) "
+        "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (version,)
+    )
+    conn.commit()
+    return version
+
+
 # ---------- Programme principal ----------
 
+def source_languages() -> List[str]:
+    """Langues à importer : LANGUAGES, ou chaque dossier <langue>/xml/ de SOURCE_ROOT."""
+    if LANGUAGES:
+        return list(LANGUAGES)
+    return sorted(d for d in os.listdir(SOURCE_ROOT) if os.path.isdir(os.path.join(SOURCE_ROOT, d, "xml")))
+
+def parse_language(lang: str) -> List[Tuple[str, Dict]]:
+    """Analyse tous les livres d'une langue -> [(catégorie, livre)] (exécuté dans un processus fils)."""
+    xml_dir = os.path.join(SOURCE_ROOT, lang, "xml")
+    xml_files = sorted(glob(os.path.join(xml_dir, "*.xml")))
+    if not xml_files:
+        print(f"[ATTENTION] Aucun XML trouvé sous {xml_dir}", file=sys.stderr)
+
+    parsed = []
+    for xml_path in xml_files:
+        code = os.path.splitext(os.path.basename(xml_path))[0].lower()
+
+        # ne traiter que les codes commençant par un chiffre
+        if not re.match(r"^\d", code):
+            continue
+        if ONLY_CODES and code not in ONLY_CODES:
+            continue
+
+        category = find_category_from_cover(lang, code)
+        parsed.append((category, parse_book_from_file(xml_path)))
+    return parsed
+
 def main():
     if not os.path.isdir(SOURCE_ROOT):
         print(f"[ERREUR] Dossier source introuvable : {SOURCE_ROOT}", file=sys.stderr)
         sys.exit(1)
 
+    languages = source_languages()
+    with ProcessPoolExecutor(max_workers=max(1, len(languages))) as pool:
+        futures = [(lang, pool.submit(parse_language, lang)) for lang in languages]
+        parsed = [(lang, category, book, check_integrity(book))
+                  for lang, future in futures for category, book in future.result()]
+
+    # un graphe cassé arrête le build avant d'ouvrir la base : ni migration ni écriture,
+    # la base en service reste intacte
+    broken = [(lang, book, report) for lang, _category, book, report in parsed
+              if report["dangling"] and f"{lang}/{book['code']}" not in ALLOW_DANGLING]
+    if broken:
+        for lang, book, report in broken:
+            targets = ", ".join(f"{src} → {dst}" for src, dst in report["dangling"][:10])
+            print(f"[ERREUR] {lang}/{book['code']} : {len(report['dangling'])} choix sans cible ({targets})",
+                  file=sys.stderr)
+        print("[ERREUR] Build interrompu, base inchangée (voir ALLOW_DANGLING)", file=sys.stderr)
+        sys.exit(1)
+
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
     try:
         init_db(conn)
 
-        xml_dir = os.path.join(SOURCE_ROOT, "en", "xml")
-        xml_files = sorted(glob(os.path.join(xml_dir, "*.xml")))
-        if not xml_files:
-            print(f"[ATTENTION] Aucun XML trouvé sous {xml_dir}", file=sys.stderr)
-
-        for xml_path in xml_files:
-            code = os.path.splitext(os.path.basename(xml_path))[0].lower()
-
-            # ne traiter que les codes commençant par un chiffre
-            if not re.match(r"^\d", code):
-                continue
-            if ONLY_CODES and code not in ONLY_CODES:
-                continue
-
-            category = find_category_from_cover(code)
-
-            book = parse_book_from_file(xml_path)
-            if not book["lang"].startswith(LANG_FILTER_PREFIX):
-                continue
-
-            book_id = upsert_book(conn, book["code"], book["title"], book["lang"], category, book.get("synopsis"))
+        # insertion dans l'ordre des langues : ids stables d'un build à l'autre
+        for lang, category, book, report in parsed:
+            book_id = upsert_book(conn, book["code"], book["title"], lang, category, book.get("synopsis"))
             insert_sections_links_images(conn, book_id, book)
-
-            print(f"✓ Importé {book['code']} — {book['title']} ({book['lang']}) [{category}] "
-                  f"→ sections: {len(book['sections'])}, liens: {len(book['links'])}, images: {len(book['images'])}")
-        print(f"\nBase créée: {DB_PATH}")
+            insert_integrity(conn, book_id, report)
+
+            warnings = ""
+            if report["dangling"] or report["duplicates"] or report["orphans"]:
+                warnings = (f" ⚠ sans cible: {len(report['dangling'])}, doublons: {len(report['duplicates'])}, "
+                            f"orphelines: {len(report['orphans'])}")
+            print(f"✓ Importé {lang}/{book['code']} — {book['title']} ({book['lang']}) [{category}] "
+                  f"→ sections: {len(book['sections'])}, liens: {len(book['links'])}, images: {len(book['images'])}"
+                  f"{warnings}")
+        version = write_build_version(conn)
+        print(f"\nBase créée: {DB_PATH} (build {version})")
     finally:
         conn.close()
 
@@ -0,0 +1,299 @@
+"""
+corpus.py
+---------
+Mode "corpus en mémoire" : tout le contenu utile de lonewolf.db (livres, sections,
+choix, illustrations, combats) est chargé au démarrage dans des structures compactes,
+et le site lit ensuite sans aucune requête SQL.
+
+- chaînes répétitives internées (sys.intern) : sec_id, cibles, catégories, mime...
+- enregistrements à __slots__ (accès `rec["champ"]` conservé pour les templates)
+- choix / illustrations en listes d'adjacence "CSR" adossées à des array('l')
+- index (langue, code) -> livre et (id du livre, sec_id) -> n° de section
+- les colonnes XML brutes (links.raw_xml) ne sont pas chargées
+
+Activation : variable d'environnement LONEWOLF_MEMORY=1 (voir app.py).
+"""
+
+import os
+import sqlite3
+import sys
+import time
+import tracemalloc
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+_intern = sys.intern
+
+
+def _i(value):
+    return _intern(value) if isinstance(value, str) else value
+
+
+def read_build_version(db_path: str) -> str:
+    """Version du build (table build_info) ; à défaut, date de modification du fichier."""
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT value FROM build_info WHERE key='build_version'").fetchone()
+        finally:
+            conn.close()
+        if row:
+            return row[0]
+    except sqlite3.Error:
+        pass
+    try:
+        return f"mtime:{os.stat(db_path).st_mtime_ns}"
+    except OSError:
+        return "absent"
+
+
+class Record:
+    """Base des enregistrements : accès par attribut ou par clé (compatible sqlite3.Row)."""
+
+    __slots__ = ()
+    _aliases: Dict[str, str] = {}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._aliases.get(key, key))
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class BookRec(Record):
+    __slots__ = ("id", "code", "title", "language", "category", "synopsis", "first", "last")
+
+    def __init__(self, id, code, title, language, category, synopsis):
+        self.id = id
+        self.code = code
+        self.title = title
+        self.language = language
+        self.category = category
+        self.synopsis = synopsis
+        # plage [first, last) des sections du livre dans Corpus.sections
+        self.first = 0
+        self.last = 0
+
+
+class SectionRec(Record):
+    __slots__ = ("id", "book_id", "sec_id", "class_", "title", "content_xml", "index")
+    _aliases = {"class": "class_"}
+
+    def __init__(self, id, book_id, sec_id, class_, title, content_xml, index):
+        self.id = id
+        self.book_id = book_id
+        self.sec_id = sec_id
+        self.class_ = class_
+        self.title = title
+        self.content_xml = content_xml
+        self.index = index
+
+
+class ChoiceRec(Record):
+    __slots__ = ("to_sec_ref", "label", "to_index", "to_section")
+
+    def __init__(self, to_sec_ref, label, to_index, to_section):
+        self.to_sec_ref = to_sec_ref
+        self.label = label
+        self.to_index = to_index
+        self.to_section = to_section     # id de la section cible (links.to_section), None si absente
+
+
+class ImageRec(Record):
+    __slots__ = ("src", "width", "height", "mime_type", "variant_class")
+
+    def __init__(self, src, width, height, mime_type, variant_class):
+        self.src = src
+        self.width = width
+        self.height = height
+        self.mime_type = mime_type
+        self.variant_class = variant_class
+
+
+class EnemyRec(Record):
+    __slots__ = ("id", "combat_id", "enemy_index", "name", "cs", "ep", "extra_json")
+
+    def __init__(self, id, combat_id, enemy_index, name, cs, ep, extra_json):
+        self.id = id
+        self.combat_id = combat_id
+        self.enemy_index = enemy_index
+        self.name = name
+        self.cs = cs
+        self.ep = ep
+        self.extra_json = extra_json
+
+
+class Corpus:
+    """Instantané immuable de la base ; on remplace l'objet entier pour recharger."""
+
+    def __init__(self, build_version: str):
+        self.build_version = build_version
+        self.books: List[BookRec] = []
+        self.by_code: Dict[Tuple[str, str], BookRec] = {}    # (langue, code)
+        self.by_language: Dict[str, List[BookRec]] = {}
+        self.sections: List[SectionRec] = []
+        self.by_key: Dict[Tuple[int, str], int] = {}          # (id du livre, sec_id)
+        self.by_rowid: Dict[int, int] = {}
+        # CSR : les choix de la section i sont [choice_off[i], choice_off[i+1])
+        self.choice_off = array("l")
+        self.choice_to = array("l")             # n° de section cible, -1 si introuvable
+        self.choice_ref: List[str] = []         # sec_id cible (interné)
+        self.choice_label: List[str] = []
+        self.image_off = array("l")
+        self.image_recs: List[ImageRec] = []
+        # n° de section -> [(combat_id, ennemis), ...] dans l'ordre du texte
+        self.combats: Dict[int, List[Tuple[int, Tuple[EnemyRec, ...]]]] = {}
+        self.stats: Dict[str, float] = {}
+
+    # ---------- Chargement ----------
+
+    @classmethod
+    def load(cls, db_path: str, measure: bool = False) -> "Corpus":
+        """
+        `measure` : empreinte mémoire via tracemalloc (stats["bytes"]) ; diagnostic
+        seulement (`benchmark.py corpus`) : le traçage ralentit le chargement plusieurs
+        fois et compte aussi les allocations des autres threads.
+        """
+        started = time.perf_counter()
+        tracing = measure and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+        corpus = cls(read_build_version(db_path))
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            corpus._load(conn)
+        finally:
+            conn.close()
+
+        if tracemalloc.is_tracing():
+            corpus.stats["bytes"] = tracemalloc.get_traced_memory()[0] - before
+        if tracing:
+            tracemalloc.stop()
+        corpus.stats["load_seconds"] = time.perf_counter() - started
+        corpus.stats["books"] = len(corpus.books)
+        corpus.stats["sections"] = len(corpus.sections)
+        corpus.stats["choices"] = len(corpus.choice_ref)
+        corpus.stats["images"] = len(corpus.image_recs)
+        corpus.stats["combats"] = len(corpus.combats)
+        return corpus
+
+    def _load(self, conn: sqlite3.Connection) -> None:
+        book_by_id: Dict[int, BookRec] = {}
+        for r in conn.execute(
+            "SELECT id, code, title, language, category, synopsis FROM books ORDER BY language, code"
+        ):
+            b = BookRec(r[0], _i(r[1]), r[2], _i(r[3]), _i(r[4]), r[5])
+            self.books.append(b)
+            self.by_code[(b.language, b.code)] = b
+            book_by_id[b.id] = b
+            self.by_language.setdefault(b.language, []).append(b)
+
+        # sections groupées par livre (plage contiguë par livre)
+        current = None
+        for r in conn.execute(
+            "SELECT id, book_id, sec_id, class, title, content_xml FROM sections ORDER BY book_id, id"
+        ):
+            book = book_by_id.get(r[1])
+            if book is None:
+                continue
+            idx = len(self.sections)
+            if book is not current:
+                if current is not None:
+                    current.last = idx
+                book.first = idx
+                current = book
+            s = SectionRec(r[0], r[1], _i(r[2]), _i(r[3]), r[4], r[5], idx)
+            self.sections.append(s)
+            self.by_key[(book.id, s.sec_id)] = idx
+            self.by_rowid[s.id] = idx
+        if current is not None:
+            current.last = len(self.sections)
+
+        n = len(self.sections)
+
+        # choix (liens rel='choice' uniquement), dans l'ordre d'insertion ; cibles résolues au build
+        per_section: List[list] = [[] for _ in range(n)]
+        for from_rowid, to_ref, to_rowid, label in conn.execute(
+            "SELECT from_section, to_sec_ref, to_section, COALESCE(display_text, to_sec_ref) "
+            "FROM links WHERE rel='choice' ORDER BY id"
+        ):
+            idx = self.by_rowid.get(from_rowid)
+            if idx is not None:
+                per_section[idx].append((to_ref, to_rowid, label))
+        for lst in per_section:
+            self.choice_off.append(len(self.choice_ref))
+            for to_ref, to_rowid, label in lst:
+                self.choice_ref.append(_i(to_ref))
+                self.choice_label.append(label)
+                self.choice_to.append(self.by_rowid.get(to_rowid, -1))
+        self.choice_off.append(len(self.choice_ref))
+
+        per_section = [[] for _ in range(n)]
+        for r in conn.execute(
+            "SELECT section_id, src, width, height, mime_type, variant_class FROM images ORDER BY id"
+        ):
+            idx = self.by_rowid.get(r[0])
+            if idx is not None:
+                per_section[idx].append(ImageRec(r[1], _i(r[2]), _i(r[3]), _i(r[4]), _i(r[5])))
+        for lst in per_section:
+            self.image_off.append(len(self.image_recs))
+            self.image_recs.extend(lst)
+        self.image_off.append(len(self.image_recs))
+
+        enemies: Dict[int, list] = {}
+        for r in conn.execute(
+            "SELECT id, combat_id, enemy_index, name, cs, ep, extra_json FROM combat_enemies ORDER BY combat_id, enemy_index"
+        ):
+            enemies.setdefault(r[1], []).append(EnemyRec(r[0], r[1], r[2], r[3], r[4], r[5], r[6]))
+        for combat_id, section_id in conn.execute("SELECT id, section_id FROM combats ORDER BY id"):
+            idx = self.by_rowid.get(section_id)
+            if idx is not None:
+                self.combats.setdefault(idx, []).append((combat_id, tuple(enemies.get(combat_id, ()))))
+
+    # ---------- Lecture ----------
+
+    def book(self, language: str, code: str) -> Optional[BookRec]:
+        return self.by_code.get((language, code))
+
+    def language_books(self, language: str) -> List[BookRec]:
+        return self.by_language.get(language, [])
+
+    def section(self, book, sec_id: str) -> Optional[SectionRec]:
+        idx = self.by_key.get((book["id"], sec_id))
+        return self.sections[idx] if idx is not None else None
+
+    def section_by_rowid(self, rowid: int) -> Optional[SectionRec]:
+        idx = self.by_rowid.get(rowid)
+        return self.sections[idx] if idx is not None else None
+
+    def book_sections(self, book: BookRec) -> List[SectionRec]:
+        return self.sections[book.first:book.last]
+
+    def choices(self, section: SectionRec) -> List[ChoiceRec]:
+        i = section.index
+        out = []
+        for k in range(self.choice_off[i], self.choice_off[i + 1]):
+            to = self.choice_to[k]
+            out.append(ChoiceRec(self.choice_ref[k], self.choice_label[k], to,
+                                 self.sections[to].id if to >= 0 else None))
+        return out
+
+    def images(self, section: SectionRec) -> List[ImageRec]:
+        i = section.index
+        return self.image_recs[self.image_off[i]:self.image_off[i + 1]]
+
+    def combat(self, section: SectionRec) -> Optional[Tuple[int, Tuple[EnemyRec, ...]]]:
+        """Premier bloc <combat> de la section (comme play())."""
+        lst = self.combats.get(section.index)
+        return lst[0] if lst else None
+
+    def section_combats(self, section: SectionRec) -> List[Tuple[int, Tuple[EnemyRec, ...]]]:
+        return self.combats.get(section.index, [])
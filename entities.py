@@ -0,0 +1,103 @@
+"""
+entities.py
+-----------
+Décodage des entités caractères Project Aon (<ch.xxx/>), partagé par l'importeur
+(build_database.py) et le rendu (render.py).
+
+- La table est générée à partir des définitions livrées avec le corpus
+  (project-aon-master/<langue>/xml/htmlchar.mod : <!ENTITY nom "valeur">),
+  en résolvant les références (&#233;, &nbsp;, &amp;…) qu'elles contiennent.
+- htmlchar.mod vise l'ISO-8859-1 : tirets, points de suspension et guillemets y
+  sont approchés en ASCII ("--", " . . .") et quelques caractères listés par
+  gamebook.dtd n'y figurent pas (fractions, ≤, ≥…). UNICODE complète / remplace
+  ces entrées, le site étant servi en UTF-8.
+- decode_entities() remplace toutes les entités en une seule passe (une
+  expression compilée + un dict) ; une entité inconnue est laissée telle quelle.
+"""
+
+import os
+import re
+from typing import Dict, Iterable, Optional
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENTITY_MODULES = (
+    os.path.join(BASE_DIR, "project-aon-master", "en", "xml", "htmlchar.mod"),
+)
+
+_ENTITY_DECL = re.compile(r'<!ENTITY\s+([A-Za-z][\w.]*)\s+"([^"]*)"\s*>')
+_REF = re.compile(r"&(#x[0-9A-Fa-f]+|#\d+|[A-Za-z][\w.]*);")
+_CH_ELEMENT = re.compile(r"<ch\.([A-Za-z][A-Za-z0-9]*)\s*(?:/>|></ch\.\1\s*>)")   # <ch.x/> ou <ch.x></ch.x>
+
+XML_PREDEFINED = {"amp": "&", "lt": "<", "gt": ">", "apos": "'", "quot": '"'}
+
+# Entrées typographiques (absentes ou approchées en ASCII dans htmlchar.mod)
+UNICODE: Dict[str, str] = {
+    "apos": "'",
+    "lsquot": "‘",
+    "rsquot": "’",
+    "ldquot": "“",
+    "rdquot": "”",
+    "minus": "−",
+    "endash": "–",
+    "emdash": "—",
+    "ellips": "…",
+    "lellips": "…",
+    "thinspace": "\u2009",
+    "plus": "+",
+    "lte": "≤",
+    "gte": "≥",
+    "frac13": "⅓", "frac23": "⅔",
+    "frac15": "⅕", "frac25": "⅖", "frac35": "⅗", "frac45": "⅘",
+    "frac16": "⅙", "frac56": "⅚",
+    "frac17": "⅐",
+    "frac18": "⅛", "frac38": "⅜", "frac58": "⅝", "frac78": "⅞",
+    "frac19": "⅑", "frac110": "⅒",
+    "frac116": "1⁄16",
+}
+
+
+def _resolve(value: str, defs: Dict[str, str], depth: int = 0) -> str:
+    def ref(m):
+        name = m.group(1)
+        if name.startswith("#x"):
+            return chr(int(name[2:], 16))
+        if name.startswith("#"):
+            return chr(int(name[1:]))
+        if name in defs and depth < 8:
+            return _resolve(defs[name], defs, depth + 1)
+        return XML_PREDEFINED.get(name, m.group(0))
+    # "&#38;#60;" : la référence produit elle-même une référence -> on relance
+    out = _REF.sub(ref, value)
+    return _resolve(out, defs, depth + 1) if out != value and "&" in out and depth < 8 else out
+
+
+def parse_entity_module(path: str) -> Dict[str, str]:
+    """{nom: caractères} d'un module .mod (<!ENTITY nom "valeur">)."""
+    with open(path, "r", encoding="iso-8859-1") as f:
+        raw = f.read()
+    defs = {m.group(1): m.group(2) for m in _ENTITY_DECL.finditer(raw)}
+    return {name: _resolve(value, defs) for name, value in defs.items()}
+
+
+def build_table(paths: Iterable[str] = ENTITY_MODULES, overrides: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    table: Dict[str, str] = {}
+    for path in paths:
+        if os.path.isfile(path):
+            for name, value in parse_entity_module(path).items():
+                table.setdefault(name, value)
+    table.update(UNICODE if overrides is None else overrides)
+    return table
+
+
+ENTITIES: Dict[str, str] = build_table()
+
+
+def _decode_one(m, _get=ENTITIES.get):
+    return _get(m.group(1), m.group(0))
+
+
+def decode_entities(text: str) -> str:
+    """Remplace chaque <ch.xxx/> par son caractère (une passe)."""
+    if not text or "<ch." not in text:
+        return text
+    return _CH_ELEMENT.sub(_decode_one, text)
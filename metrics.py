@@ -0,0 +1,340 @@
+"""
+metrics.py
+----------
+Instrumentation légère du site Flask, exposée au format texte Prometheus sur /metrics.
+
+- latence par route (histogramme) et nombre de requêtes par route / statut
+- par requête : nombre d'instructions SQL (trace callback sqlite3) et temps SQL
+  (execute et lecture des lignes)
+- temps passé dans les fonctions décorées par @timed (rendu XML, résolution
+  d'illustrations) et dans le rendu des templates (signaux Flask)
+- taux de hit des caches enregistrés via register_cache()
+- journal des requêtes lentes (opt-in) avec le détail des requêtes SQL
+
+Activation :
+    LONEWOLF_METRICS=1      instrumentation des requêtes
+    LONEWOLF_SLOW_MS=200    journal des requêtes de plus de 200 ms (active aussi l'instrumentation)
+
+Désactivé, @timed renvoie la fonction telle quelle et get_db() ouvre une connexion
+sqlite3 ordinaire : aucun surcoût. Avec serve.py, chaque worker expose ses propres compteurs :
+exploitables avec --workers 1 seulement (un scrape tombe sur un worker quelconque).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+SLOW_MS = float(os.environ.get("LONEWOLF_SLOW_MS", "0"))
+ENABLED = os.environ.get("LONEWOLF_METRICS", "0") == "1" or SLOW_MS > 0
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+_perf = time.perf_counter
+_local = threading.local()
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # dernier = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Tuple[str, tuple, Dict[tuple, Histogram]]] = {}
+        self.counters: Dict[str, Tuple[str, Dict[tuple, float]]] = {}
+        self.caches: Dict[str, Callable[[], Tuple[int, int]]] = {}
+        self.gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+
+    def histogram(self, name, help_text, bounds=LATENCY_BUCKETS):
+        self.histograms.setdefault(name, (help_text, bounds, {}))
+
+    def counter(self, name, help_text):
+        self.counters.setdefault(name, (help_text, {}))
+
+    def observe(self, name, labels, value):
+        _help, bounds, series = self.histograms[name]
+        with self._lock:
+            h = series.get(labels)
+            if h is None:
+                h = series[labels] = Histogram(bounds)
+            h.observe(value)
+
+    def inc(self, name, labels, value=1):
+        series = self.counters[name][1]
+        with self._lock:
+            series[labels] = series.get(labels, 0) + value
+
+    # ---------- Export Prometheus ----------
+
+    def render(self) -> str:
+        out: List[str] = []
+        with self._lock:
+            for name, (help_text, bounds, series) in sorted(self.histograms.items()):
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} histogram")
+                for labels, h in sorted(series.items()):
+                    cumulative = 0
+                    for bound, n in zip(bounds, h.counts):
+                        cumulative += n
+                        out.append(f"{name}_bucket{_labels(labels + (('le', _num(bound)),))} {cumulative}")
+                    out.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h.count}")
+                    out.append(f"{name}_sum{_labels(labels)} {_num(h.sum)}")
+                    out.append(f"{name}_count{_labels(labels)} {h.count}")
+            for name, (help_text, series) in sorted(self.counters.items()):
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} counter")
+                for labels, v in sorted(series.items()):
+                    out.append(f"{name}{_labels(labels)} {_num(v)}")
+
+        if self.caches:
+            stats = {name: fn() for name, fn in sorted(self.caches.items())}
+            for metric, help_text, pick in (
+                ("lonewolf_cache_hits_total", "Hits par cache", lambda hm: hm[0]),
+                ("lonewolf_cache_misses_total", "Misses par cache", lambda hm: hm[1]),
+                ("lonewolf_cache_hit_ratio", "Taux de hit par cache", lambda hm: hm[0] / (hm[0] + hm[1]) if hm[0] + hm[1] else 0.0),
+            ):
+                out.append(f"# HELP {metric} {help_text}")
+                out.append(f"# TYPE {metric} {'gauge' if metric.endswith('ratio') else 'counter'}")
+                for name, hm in stats.items():
+                    out.append(f"{metric}{_labels((('cache', name),))} {_num(pick(hm))}")
+
+        for name, (help_text, fn) in sorted(self.gauges.items()):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {_num(fn())}")
+        return "\n".join(out) + "\n"
+
+
+def _num(v) -> str:
+    if isinstance(v, float):
+        return str(int(v)) if v.is_integer() else repr(v)
+    return str(v)
+
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in labels) + "}"
+
+
+REGISTRY = Registry()
+REGISTRY.histogram("lonewolf_request_duration_seconds", "Durée des requêtes HTTP par route")
+REGISTRY.histogram("lonewolf_request_sql_seconds", "Temps SQL par requête HTTP (execute et lecture des lignes)")
+REGISTRY.histogram("lonewolf_request_sql_statements", "Instructions SQL par requête HTTP", COUNT_BUCKETS)
+REGISTRY.histogram("lonewolf_function_seconds", "Temps passé par fonction instrumentée")
+REGISTRY.counter("lonewolf_requests_total", "Requêtes HTTP par route et statut")
+
+
+def register_cache(name: str, stats: Callable[[], Tuple[int, int]]) -> None:
+    """`stats()` renvoie (hits, misses) ; lu uniquement au moment du scrape."""
+    REGISTRY.caches[name] = stats
+
+
+def register_gauge(name: str, help_text: str, value: Callable[[], float]) -> None:
+    REGISTRY.gauges[name] = (help_text, value)
+
+
+# ---------- Par requête ----------
+
+class RequestStats:
+    __slots__ = ("start", "status", "sql_count", "sql_time", "statements", "timers")
+
+    def __init__(self):
+        self.start = _perf()
+        self.status = None      # fixé par after_request ; None = exception non gérée
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements: List[Tuple[str, float]] = []
+        self.timers: Dict[str, float] = {}
+
+
+def _current():
+    return getattr(_local, "req", None)
+
+
+def _add_timer(name, elapsed):
+    REGISTRY.observe("lonewolf_function_seconds", (("function", name),), elapsed)
+    req = _current()
+    if req is not None:
+        req.timers[name] = req.timers.get(name, 0.0) + elapsed
+
+
+def timed(name: str):
+    """Décorateur : mesure le temps passé dans la fonction (sans effet si désactivé)."""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+
+        def wrapper(*args, **kwargs):
+            t0 = _perf()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _add_timer(name, _perf() - t0)
+
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        wrapper.__wrapped__ = fn
+        return wrapper
+    return decorate
+
+
+def _add_sql_time(dt, entry=None):
+    req = _current()
+    if req is not None:
+        req.sql_time += dt
+        if entry is not None:
+            entry[1] += dt
+
+
+class Cursor(sqlite3.Cursor):
+    """
+    Curseur chronométré : execute (préparation + premier pas) et lecture des lignes
+    (fetchone/fetchmany/fetchall, itération) comptent dans le temps SQL de la requête.
+    """
+
+    _entry = None   # [sql, temps] dans le journal des requêtes lentes
+
+    def execute(self, sql, parameters=()):
+        t0 = _perf()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            dt = _perf() - t0
+            req = _current()
+            if req is not None:
+                req.sql_time += dt
+                if SLOW_MS:
+                    self._entry = [" ".join(sql.split()), dt]
+                    req.statements.append(self._entry)
+
+    def fetchone(self):
+        t0 = _perf()
+        try:
+            return super().fetchone()
+        finally:
+            _add_sql_time(_perf() - t0, self._entry)
+
+    def fetchmany(self, size=None):
+        t0 = _perf()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            _add_sql_time(_perf() - t0, self._entry)
+
+    def fetchall(self):
+        t0 = _perf()
+        try:
+            return super().fetchall()
+        finally:
+            _add_sql_time(_perf() - t0, self._entry)
+
+    def __next__(self):
+        t0 = _perf()
+        try:
+            return super().__next__()
+        finally:
+            _add_sql_time(_perf() - t0, self._entry)
+
+
+class Connection(sqlite3.Connection):
+    """Connexion sqlite3 dont les execute passent par un curseur chronométré."""
+
+    def execute(self, sql, parameters=()):
+        return self.cursor(Cursor).execute(sql, parameters)
+
+
+def _trace(_statement):
+    req = _current()
+    if req is not None:
+        req.sql_count += 1
+
+
+def connect(path: str) -> sqlite3.Connection:
+    if not ENABLED:
+        return sqlite3.connect(path)
+    conn = sqlite3.connect(path, factory=Connection)
+    conn.set_trace_callback(_trace)
+    return conn
+
+
+def init_app(app) -> None:
+    """Branche les hooks Flask et la route /metrics."""
+    from flask import Response, request, template_rendered, before_render_template
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    if not ENABLED:
+        return
+
+    @app.before_request
+    def _metrics_start():
+        _local.req = RequestStats()
+
+    def _template_start(sender, template, context, **extra):
+        req = _current()
+        if req is not None:
+            req.timers["_template_start"] = _perf()
+
+    def _template_done(sender, template, context, **extra):
+        req = _current()
+        if req is not None and "_template_start" in req.timers:
+            _add_timer("render_template", _perf() - req.timers.pop("_template_start"))
+
+    before_render_template.connect(_template_start, app, weak=False)
+    template_rendered.connect(_template_done, app, weak=False)
+
+    @app.after_request
+    def _metrics_status(response):
+        req = _current()
+        if req is not None:
+            req.status = response.status_code
+        return response
+
+    # teardown_request s'exécute aussi quand after_request est sauté (exception non gérée) :
+    # les 500 sont comptés avec leur latence
+    @app.teardown_request
+    def _metrics_done(exc):
+        req = _current()
+        if req is None:
+            return
+        _local.req = None
+        elapsed = _perf() - req.start
+        status = req.status if req.status is not None else 500
+        route = request.endpoint or "<aucune>"
+        labels = (("route", route),)
+        REGISTRY.observe("lonewolf_request_duration_seconds", labels, elapsed)
+        REGISTRY.observe("lonewolf_request_sql_seconds", labels, req.sql_time)
+        REGISTRY.observe("lonewolf_request_sql_statements", labels, req.sql_count)
+        REGISTRY.inc("lonewolf_requests_total", labels + (("status", status),))
+
+        if SLOW_MS and elapsed * 1000 >= SLOW_MS:
+            detail = "; ".join(f"{name}={t * 1000:.1f}ms" for name, t in sorted(req.timers.items()))
+            queries = "\n".join(f"    {t * 1000:7.2f} ms  {sql}" for sql, t in
+                                sorted(req.statements, key=lambda x: -x[1]))
+            app.logger.warning(
+                "Requête lente %s %s (%d) : %.1f ms, %d SQL (%.1f ms) %s\n%s",
+                request.method, request.full_path, status, elapsed * 1000,
+                req.sql_count, req.sql_time * 1000, detail, queries,
+            )
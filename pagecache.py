@@ -0,0 +1,209 @@
+"""
+pagecache.py
+------------
+Cache des sections déjà rendues et préchauffage spéculatif des cibles de choix.
+
+- PageCache : LRU (id du livre, sec_id) -> SectionPage, c.-à-d. la partie de /play
+  commune à tous les lecteurs (HTML du texte, URLs des illustrations, choix, combat).
+  La progression du lecteur et le conseil d'itinéraire restent calculés à chaque page.
+  Vidé à chaque nouveau build (generation : une page rendue avant le vidage est ignorée).
+- CacheWarmer : après une page /play, les cibles de ses choix sont placées dans une
+  file bornée ; un petit pool de threads les rend à l'avance dans le PageCache.
+  - déduplication : une cible déjà en cache ou déjà en file n'est pas ajoutée ;
+  - contre-pression : file pleine -> la cible est abandonnée, la requête n'attend jamais ;
+  - une requête pour une page en cours de rendu par le pool attend celle-ci (quelques ms)
+    au lieu de la rendre une seconde fois ; encore en file, la requête la rend elle-même
+    et le pool la sautera ;
+  - priorité aux requêtes : le pool ne rend rien tant qu'une requête est en cours
+    (attente sur l'événement `idle`) ; une cible en file depuis plus de WARM_STALE
+    secondes est abandonnée ;
+  - compteurs : pages préchauffées, utilisées (premier hit), évincées sans avoir servi.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+
+PAGE_CACHE_SIZE = 4096    # sections rendues gardées en mémoire
+WARM_THREADS = 1
+WARM_QUEUE_SIZE = 256     # au-delà, les cibles proposées sont abandonnées
+WARM_WAIT = 0.05          # attente max. (s) d'une page en cours de préchauffage
+WARM_STALE = 2.0          # cible abandonnée si le serveur reste occupé plus longtemps (s)
+WARM_SETTLE = 0.005       # délai (s) après la fin d'une requête : laisse partir la réponse
+
+
+class SectionPage:
+    __slots__ = ("content_html", "illu_urls", "choices", "combat_id")
+
+    def __init__(self, content_html, illu_urls, choices, combat_id):
+        self.content_html = content_html
+        self.illu_urls = illu_urls
+        self.choices = choices
+        self.combat_id = combat_id
+
+    @property
+    def has_combat(self) -> bool:
+        return self.combat_id is not None
+
+
+class PageCache:
+    def __init__(self, size: int = PAGE_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        # clé -> [page, préchauffée et pas encore servie]
+        self._pages: "OrderedDict[Hashable, list]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0
+        self.warm_used = 0
+        self.warm_wasted = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self._pages
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def get(self, key, count_miss: bool = True) -> Optional[SectionPage]:
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            if entry[1]:
+                entry[1] = False
+                self.warm_used += 1
+            return entry[0]
+
+    def put(self, key, page: SectionPage, warmed: bool = False, generation: Optional[int] = None) -> None:
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return   # rendue avec l'ancien build
+            if warmed:
+                if key in self._pages:
+                    return
+                self.warmed += 1
+            self._pages[key] = [page, warmed]
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.size:
+                _key, (_page, unused) = self._pages.popitem(last=False)
+                if unused:
+                    self.warm_wasted += 1
+
+    def clear(self) -> None:
+        """À appeler quand la base change (nouveau build)."""
+        with self._lock:
+            self._pages.clear()
+            self.generation += 1
+
+
+class CacheWarmer:
+    """
+    `build(payload)` est exécuté dans un thread du pool et doit remplir le cache ;
+    `idle` (facultatif) est positionné quand aucune requête n'est en cours ;
+    `submit()` ne bloque jamais.
+    """
+
+    def __init__(self, cache: PageCache, build: Callable, idle: Optional[threading.Event] = None,
+                 threads: int = WARM_THREADS, queue_size: int = WARM_QUEUE_SIZE):
+        self.cache = cache
+        self.build = build
+        self.idle = idle
+        self.threads = threads
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(queue_size)
+        self._pending = set()
+        self._running: Dict[Hashable, threading.Event] = {}
+        self._pid = None
+        self.enqueued = 0
+        self.deduped = 0
+        self.dropped = 0
+        self.stale = 0
+        self.errors = 0
+
+    def _ensure_workers(self) -> None:
+        # (re)crée file et threads après un fork (serve.py) : les threads ne sont pas hérités
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._pending = set()
+            self._running = {}
+            for i in range(self.threads):
+                threading.Thread(target=self._run, name=f"cache-warmer-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self) -> None:
+        q = self._queue
+        while True:
+            key, payload, queued_at = q.get()
+            # le lecteur a sans doute déjà cliqué : inutile de rendre une cible trop ancienne
+            if not self._wait_idle(queued_at + WARM_STALE):
+                self.stale += 1
+                with self._lock:
+                    self._pending.discard(key)
+                continue
+            with self._lock:
+                done = self._running[key] = threading.Event()
+            try:
+                if key not in self.cache:
+                    self.build(payload)
+            except Exception:
+                self.errors += 1
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                    del self._running[key]
+                done.set()
+
+    def _wait_idle(self, deadline: float) -> bool:
+        """Attend que le serveur soit inactif depuis WARM_SETTLE ; False après `deadline`."""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.idle is None:
+                return True
+            if self.idle.wait(remaining):
+                # le thread de la requête doit encore envoyer la réponse (GIL) : on le laisse finir
+                time.sleep(WARM_SETTLE)
+                if self.idle.is_set():
+                    return True
+
+    def submit(self, key, payload) -> bool:
+        """Propose une page à préchauffer ; False si déjà connue ou file pleine."""
+        if key in self.cache:
+            self.deduped += 1
+            return False
+        self._ensure_workers()
+        with self._lock:
+            if key in self._pending:
+                self.deduped += 1
+                return False
+            try:
+                self._queue.put_nowait((key, payload, time.monotonic()))
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._pending.add(key)
+            self.enqueued += 1
+        return True
+
+    def wait(self, key, timeout: float = WARM_WAIT) -> bool:
+        """Si `key` est en cours de rendu dans le pool, attend la fin ; False sinon."""
+        done = self._running.get(key)
+        return done is not None and done.wait(timeout)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
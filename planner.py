@@ -0,0 +1,362 @@
+"""
+planner.py
+----------
+Planificateur d'itinéraire "le plus sûr" sur le graphe des choix d'un livre.
+
+- Le graphe (liens rel='choice') et les combats de chaque livre sont chargés
+  une seule fois en mémoire (listes d'adjacence indexées par entier).
+- La probabilité de gagner un combat est calculée exactement à partir de la
+  même fonction de résolution que le site (CRT ou fallback heuristique).
+- Deux routes sont proposées vers la fin du livre (plus grand numéro de section) :
+  la plus sûre (max. de la probabilité de survie, meilleur d'abord sur -log p)
+  et la plus courte (BFS en nombre de choix).
+- La survie d'une route reporte l'EP perdu d'un combat sur le suivant (sans soins
+  ni repas), dans la recherche de la route la plus sûre comme dans le résultat.
+- Une route vaut None si la fin est inaccessible ; une route dont tous les chemins
+  passent par un combat perdu d'avance est renvoyée avec une survie de 0.
+- CS et EP sont ramenés aux bornes du jeu (MAX_CS, MAX_EP ; écart de CS au-delà
+  de la table des combats = dernière colonne) : calcul et caches restent bornés.
+- Les résultats sont mis en cache par (livre, section de départ, CS, tranche d'EP).
+"""
+
+import heapq
+import math
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from corpus import Corpus
+
+# Taille d'une tranche d'EP pour le cache (on arrondit vers le bas : estimation prudente)
+EP_BUCKET = 2
+ROUTE_CACHE_SIZE = 4096
+FIGHT_CACHE_SIZE = 4096
+
+MAX_CS = 99         # CS du joueur ramené à [0, MAX_CS]
+MAX_EP = 100        # EP du joueur ramené à [1, MAX_EP]
+MAX_CS_DIFF = 12    # au-delà, la table des combats (et le fallback) donne les mêmes dégâts
+
+
+def _sect_num(sec_id: str) -> int:
+    try:
+        return int(sec_id[4:]) if sec_id.startswith("sect") else -1
+    except ValueError:
+        return -1
+
+
+class BookGraph:
+    """Graphe compact d'un livre : index entier par section, adjacence en listes."""
+
+    __slots__ = ("book_id", "sec_ids", "index", "adj", "combats", "ending")
+
+    def __init__(self, book_id: int, sec_ids: List[str]):
+        self.book_id = book_id
+        self.sec_ids = sec_ids
+        self.index = {sid: i for i, sid in enumerate(sec_ids)}
+        self.adj: List[List[int]] = [[] for _ in sec_ids]
+        # par section : tuple d'ennemis (cs, ep) ; vide = pas de combat
+        self.combats: List[Tuple[Tuple[int, int], ...]] = [() for _ in sec_ids]
+        nums = [(_sect_num(s), i) for i, s in enumerate(sec_ids)]
+        best = max(nums) if nums else (-1, None)
+        self.ending: Optional[int] = best[1] if best[0] > 0 else None
+
+    @classmethod
+    def from_db(cls, db, book_id: int) -> "BookGraph":
+        rows = db.execute("SELECT id, sec_id FROM sections WHERE book_id=? ORDER BY id", (book_id,)).fetchall()
+        rowid_to_idx = {}
+        graph = cls(book_id, [r[1] for r in rows])
+        for i, r in enumerate(rows):
+            rowid_to_idx[r[0]] = i
+
+        for from_rowid, to_rowid in db.execute(
+            "SELECT from_section, to_section FROM links WHERE book_id=? AND rel='choice' ORDER BY id",
+            (book_id,),
+        ):
+            src = rowid_to_idx.get(from_rowid)
+            dst = rowid_to_idx.get(to_rowid)
+            if src is None or dst is None or dst in graph.adj[src]:
+                continue
+            graph.adj[src].append(dst)
+
+        enemies: Dict[int, List[Tuple[int, int]]] = {}
+        for section_id, cs, ep in db.execute(
+            """SELECT c.section_id, e.cs, e.ep
+               FROM combats c JOIN combat_enemies e ON e.combat_id = c.id
+               WHERE c.book_id=?
+               ORDER BY c.id, e.enemy_index""",
+            (book_id,),
+        ):
+            # ennemis sans CS/EP connus : ignorés (on ne sait pas les évaluer)
+            if cs is None or ep is None:
+                continue
+            idx = rowid_to_idx.get(section_id)
+            if idx is not None:
+                enemies.setdefault(idx, []).append((int(cs), int(ep)))
+        for idx, lst in enemies.items():
+            graph.combats[idx] = tuple(lst)
+        return graph
+
+    @classmethod
+    def from_corpus(cls, corpus: Corpus, book_id: int) -> Optional["BookGraph"]:
+        book = next((b for b in corpus.books if b.id == book_id), None)
+        if book is None:
+            return None
+        graph = cls(book_id, [s.sec_id for s in corpus.book_sections(book)])
+        for i, sec in enumerate(corpus.book_sections(book)):
+            for k in range(corpus.choice_off[sec.index], corpus.choice_off[sec.index + 1]):
+                dst = corpus.choice_to[k]
+                if dst < 0:
+                    continue
+                dst -= book.first
+                if dst not in graph.adj[i]:
+                    graph.adj[i].append(dst)
+            enemies = tuple(
+                (e.cs, e.ep)
+                for _combat_id, lst in corpus.section_combats(sec)
+                for e in lst
+                if e.cs is not None and e.ep is not None
+            )
+            if enemies:
+                graph.combats[i] = enemies
+        return graph
+
+
+class RoutePlanner:
+    """
+    Calcule les routes conseillées. `resolve` est la fonction de résolution
+    d'un round (cs_diff, crt, roll) -> (dmg_enemy, dmg_lw) utilisée par le site.
+    """
+
+    def __init__(self, resolve: Callable, crt=None, cache_size: int = ROUTE_CACHE_SIZE):
+        self.resolve = resolve
+        self.crt = crt
+        self.cache_size = cache_size
+        self._graphs: Dict[int, BookGraph] = {}
+        self._routes: "OrderedDict[tuple, dict]" = OrderedDict()
+        # écarts de CS bornés à [-MAX_CS_DIFF, MAX_CS_DIFF] : au plus 25 entrées
+        self._rounds: Dict[int, List[Tuple[int, int, float]]] = {}
+        self._fights: "OrderedDict[tuple, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    # ---------- Graphe ----------
+
+    def graph(self, source, book_id: int, generation: Optional[int] = None) -> BookGraph:
+        """`source` : connexion sqlite3 ou Corpus en mémoire."""
+        g = self._graphs.get(book_id) if generation in (None, self.generation) else None
+        if g is None:
+            if isinstance(source, Corpus):
+                g = BookGraph.from_corpus(source, book_id)
+            else:
+                g = BookGraph.from_db(source, book_id)
+            with self._lock:
+                if generation in (None, self.generation):
+                    self._graphs[book_id] = g
+        return g
+
+    def clear(self) -> None:
+        """À appeler quand la base change (nouveau build)."""
+        with self._lock:
+            self._graphs.clear()
+            self._routes.clear()
+            self.generation += 1
+
+    # ---------- Combats ----------
+
+    @staticmethod
+    def clamp(lw_cs: int, lw_ep: int) -> Tuple[int, int]:
+        """CS/EP saisis par le lecteur ramenés aux bornes du jeu."""
+        return max(0, min(MAX_CS, int(lw_cs))), max(1, min(MAX_EP, int(lw_ep)))
+
+    def _round_outcomes(self, cs_diff: int) -> List[Tuple[int, int, float]]:
+        """Dégâts possibles d'un round (jets 0..9 équiprobables), rounds nuls exclus."""
+        cs_diff = max(-MAX_CS_DIFF, min(MAX_CS_DIFF, cs_diff))
+        cached = self._rounds.get(cs_diff)
+        if cached is not None:
+            return cached
+        counts: Dict[Tuple[int, int], int] = {}
+        for roll in range(10):
+            e_dmg, lw_dmg = self.resolve(cs_diff, self.crt, roll)
+            e_dmg, lw_dmg = max(0, int(e_dmg)), max(0, int(lw_dmg))
+            if e_dmg == 0 and lw_dmg == 0:
+                continue  # le round ne change rien : on relance
+            counts[(e_dmg, lw_dmg)] = counts.get((e_dmg, lw_dmg), 0) + 1
+        total = sum(counts.values())
+        outcomes = [(e, lw, n / total) for (e, lw), n in counts.items()] if total else []
+        self._rounds[cs_diff] = outcomes
+        return outcomes
+
+    def _fight(self, lw_cs: int, dist: Dict[int, float], en_cs: int, en_ep: int) -> Dict[int, float]:
+        """
+        Distribution de l'EP restant du joueur s'il gagne (la somme = proba de victoire),
+        à partir d'une distribution de son EP avant le combat.
+        Propagation itérative de la probabilité sur les états (EP joueur, EP ennemi) :
+        un round fait baisser au moins l'un des deux, on les parcourt donc en décroissant.
+        """
+        outcomes = self._round_outcomes(lw_cs - en_cs)
+        if not outcomes or not dist:
+            return {}
+        if en_ep <= 0:
+            return dict(dist)
+        mass: Dict[Tuple[int, int], float] = {(ep, en_ep): p for ep, p in dist.items() if ep > 0}
+        res: Dict[int, float] = {}
+        for lw in range(max(dist), 0, -1):
+            for en in range(en_ep, 0, -1):
+                p = mass.pop((lw, en), 0.0)
+                if not p:
+                    continue
+                for e_dmg, lw_dmg, q in outcomes:
+                    nlw, nen = lw - lw_dmg, en - e_dmg
+                    if nlw <= 0:
+                        continue  # mort, même si l'ennemi tombe au même round (cf. app.combat_step)
+                    if nen <= 0:
+                        res[nlw] = res.get(nlw, 0.0) + p * q
+                    else:
+                        mass[(nlw, nen)] = mass.get((nlw, nen), 0.0) + p * q
+        return res
+
+    def _combat(self, lw_cs: int, dist: Dict[int, float], enemies: Tuple[Tuple[int, int], ...]) -> Dict[int, float]:
+        """Ennemis affrontés l'un après l'autre, EP conservé de l'un à l'autre."""
+        for en_cs, en_ep in enemies:
+            dist = self._fight(lw_cs, dist, en_cs, en_ep)
+        return dist
+
+    def survival(self, lw_cs: int, lw_ep: int, enemies: Tuple[Tuple[int, int], ...]) -> float:
+        """Probabilité de survivre à un combat en l'abordant avec lw_ep (résultats en cache LRU)."""
+        if not enemies:
+            return 1.0
+        key = (lw_cs, lw_ep, enemies)
+        with self._lock:
+            p = self._fights.get(key)
+            if p is not None:
+                self._fights.move_to_end(key)
+                return p
+        p = min(1.0, float(sum(self._combat(lw_cs, {lw_ep: 1.0}, enemies).values())))
+        with self._lock:
+            self._fights[key] = p
+            if len(self._fights) > FIGHT_CACHE_SIZE:
+                self._fights.popitem(last=False)
+        return p
+
+    # ---------- Routes ----------
+
+    def plan(self, source, book_id: int, start: str, lw_cs: int, lw_ep: int,
+             generation: Optional[int] = None) -> Optional[dict]:
+        """
+        Renvoie {"ending", "safest", "shortest"} (chaque route : path, steps, survival)
+        ou None si la section est inconnue. Une route vaut None si la fin est inaccessible,
+        et a une survie de 0 si elle est accessible mais perdue d'avance.
+        `generation` : celle lue avec `source` ; calculé avant un clear(), le résultat
+        n'est pas mis en cache.
+        """
+        lw_cs, lw_ep = self.clamp(lw_cs, lw_ep)
+        lw_ep = max(1, lw_ep - lw_ep % EP_BUCKET)
+        key = (book_id, start, lw_cs, lw_ep)
+
+        with self._lock:
+            cached = self._routes.get(key) if generation in (None, self.generation) else None
+            if cached is not None:
+                self._routes.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        g = self.graph(source, book_id, generation)
+        if g is None:
+            return None
+        src = g.index.get(start)
+        if src is None:
+            return None
+
+        shortest = self._shortest(g, src, lw_cs, lw_ep)
+        result = {
+            "ending": g.sec_ids[g.ending] if g.ending is not None else None,
+            "safest": self._safest(g, src, lw_cs, lw_ep, shortest),
+            "shortest": shortest,
+        }
+        with self._lock:
+            if generation in (None, self.generation):
+                self._routes[key] = result
+                if len(self._routes) > self.cache_size:
+                    self._routes.popitem(last=False)
+        return result
+
+    def _route(self, g: BookGraph, path: List[int], lw_cs: int, lw_ep: int) -> dict:
+        """Survie le long de la route : l'EP restant après un combat est celui du suivant."""
+        dist = {lw_ep: 1.0}
+        for i in path:
+            if g.combats[i]:
+                dist = self._combat(lw_cs, dist, g.combats[i])
+        p = min(1.0, float(sum(dist.values())))
+        return {"path": [g.sec_ids[i] for i in path], "steps": len(path) - 1, "survival": p}
+
+    def _safest(self, g: BookGraph, src: int, lw_cs: int, lw_ep: int, shortest: Optional[dict]) -> Optional[dict]:
+        """
+        Meilleur d'abord sur (section, distribution de l'EP) : chaque section garde la
+        distribution de plus forte survie qui l'atteint (à survie égale, le moins de choix),
+        l'EP perdu en combat étant reporté. Une survie moindre pouvant laisser plus d'EP
+        pour la suite, la recherche reste heuristique : la route la plus courte est
+        évaluée aussi et la meilleure des deux est retenue.
+        """
+        if shortest is None:
+            return None  # fin inaccessible
+
+        def cost(dist: Dict[int, float]) -> float:
+            p = sum(dist.values())
+            return -math.log(p) if p > 0.0 else math.inf
+
+        def enter(i: int, dist: Dict[int, float]) -> Dict[int, float]:
+            return self._combat(lw_cs, dist, g.combats[i]) if g.combats[i] else dist
+
+        start = enter(src, {lw_ep: 1.0})
+        best = {src: (cost(start), 0)}
+        dists = {src: start}
+        prev: Dict[int, int] = {}
+        heap = [(best[src][0], 0, src)]
+        while heap:
+            c, steps, u = heapq.heappop(heap)
+            if best[u] < (c, steps):
+                continue
+            if u == g.ending:
+                break
+            for v in g.adj[u]:
+                if v in best and best[v] <= (c, steps + 1):
+                    continue  # coût non décroissant le long d'une route : inutile de combattre
+                dist = enter(v, dists[u])
+                cand = (cost(dist), steps + 1)
+                if cand < best.get(v, (math.inf, math.inf)):
+                    best[v] = cand
+                    dists[v] = dist
+                    prev[v] = u
+                    heapq.heappush(heap, (cand[0], cand[1], v))
+
+        path = [g.ending]
+        while path[-1] != src:
+            path.append(prev[path[-1]])
+        path.reverse()
+        found = self._route(g, path, lw_cs, lw_ep)
+        return max((shortest, found), key=lambda r: (r["survival"], -r["steps"]))
+
+    def _shortest(self, g: BookGraph, src: int, lw_cs: int, lw_ep: int) -> Optional[dict]:
+        """BFS en nombre de choix (sans tenir compte des combats)."""
+        if g.ending is None:
+            return None
+        prev = {src: src}
+        queue = deque([src])
+        while queue:
+            u = queue.popleft()
+            if u == g.ending:
+                break
+            for v in g.adj[u]:
+                if v not in prev:
+                    prev[v] = u
+                    queue.append(v)
+        if g.ending not in prev:
+            return None
+        path = [g.ending]
+        while path[-1] != src:
+            path.append(prev[path[-1]])
+        path.reverse()
+        return self._route(g, path, lw_cs, lw_ep)
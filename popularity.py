@@ -0,0 +1,207 @@
+"""
+popularity.py
+-------------
+Popularité des sections (pages /play et combats engagés), pour précharger les caches.
+
+- Enregistrement sans verrou : un hit = un deque.append (atomique en CPython),
+  quelques dixièmes de µs sur le chemin de la requête.
+- Un thread vide la file toutes les FLUSH_INTERVAL secondes, agrège les hits par
+  (livre, section) et les ajoute en une transaction à la table
+  section_popularity (base séparée en mode WAL : data/popularity.db).
+- Décroissance exponentielle (demi-vie HALF_LIFE) : les scores sont multipliés par
+  0.5 ** (écoulé / HALF_LIFE) au plus toutes les DECAY_EVERY secondes, dans la même
+  transaction ; une popularité ancienne s'efface, les scores négligeables sont purgés.
+- Clés textuelles (livre, sec_id) : elles survivent à la régénération de lonewolf.db.
+  Le livre est identifié comme dans progress.py (app.book_key : code seul pour la
+  langue par défaut, sinon "<langue>/<code>").
+- La base n'est ouverte (et son schéma créé) qu'au premier hit écrit ou lu.
+"""
+
+import argparse
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from typing import List, Tuple
+
+FLUSH_INTERVAL = 30.0           # secondes
+HALF_LIFE = 7 * 24 * 3600.0     # une semaine
+DECAY_EVERY = 3600.0            # décroissance appliquée au plus une fois par heure
+MIN_SCORE = 0.05                # en dessous : ligne supprimée
+MAX_PENDING = 1_000_000         # hits en attente au-delà desquels les plus anciens sont perdus
+
+PLAY, COMBAT = "play", "combat"
+
+SCHEMA_SQL = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+
+CREATE TABLE IF NOT EXISTS section_popularity (
+    book_code   TEXT NOT NULL,      -- clé du livre, comme reader_progress.book_code
+    sec_id      TEXT NOT NULL,
+    score       REAL NOT NULL,      -- hits pondérés par la décroissance
+    plays       INTEGER NOT NULL DEFAULT 0,
+    combats     INTEGER NOT NULL DEFAULT 0,
+    updated_at  REAL NOT NULL,
+    PRIMARY KEY (book_code, sec_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_popularity_score ON section_popularity(score DESC);
+
+CREATE TABLE IF NOT EXISTS popularity_meta (
+    key    TEXT PRIMARY KEY,
+    value  REAL
+);
+"""
+
+
+class PopularityRecorder:
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._hits: deque = deque(maxlen=MAX_PENDING)
+        self._flush_lock = threading.Lock()
+        self._conn_local = threading.local()
+        self._thread = None
+        self._pid = None
+        self.flushed_hits = 0
+        self.flushes = 0
+        self._schema_ready = False
+        atexit.register(self.flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._conn_local, "conn", None)
+        if conn is None or self._conn_local.pid != os.getpid():
+            if not self._schema_ready:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 10000")
+            if not self._schema_ready:
+                conn.executescript(SCHEMA_SQL)
+                self._schema_ready = True
+            self._conn_local.conn = conn
+            self._conn_local.pid = os.getpid()
+        return conn
+
+    def close(self) -> None:
+        """Ferme la connexion du thread courant (serve.py : avant un fork, cf. sqlite.org/howtocorrupt)."""
+        conn = getattr(self._conn_local, "conn", None)
+        if conn is not None:
+            self._conn_local.conn = None
+            conn.close()
+
+    # ---------- Enregistrement (chemin des requêtes) ----------
+
+    def record(self, book_code: str, sec_id: str, kind: str = PLAY) -> None:
+        """`book_code` : clé du livre (app.book_key)."""
+        if self._pid != os.getpid():
+            self._start_flusher()
+        self._hits.append((book_code, sec_id, kind))
+
+    @property
+    def pending(self) -> int:
+        return len(self._hits)
+
+    # ---------- Thread d'écriture ----------
+
+    def _start_flusher(self) -> None:
+        # (re)lance le thread après un fork (serve.py) : les threads ne sont pas hérités
+        with self._flush_lock:
+            if self._pid == os.getpid():
+                return
+            self._hits = deque(maxlen=MAX_PENDING)
+            self._thread = threading.Thread(target=self._run, name="popularity-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass   # base verrouillée : les hits restent agrégés pour le tour suivant
+
+    def flush(self) -> int:
+        """Agrège les hits en attente et les écrit en une transaction (avec décroissance)."""
+        with self._flush_lock:
+            hits = self._hits
+            counts = Counter()
+            try:
+                while True:
+                    counts[hits.popleft()] += 1
+            except IndexError:
+                pass
+            if not counts:
+                return 0
+
+            rows = {}
+            for (code, sec_id, kind), n in counts.items():
+                row = rows.setdefault((code, sec_id), [0, 0])
+                row[0 if kind == PLAY else 1] += n
+
+            now = time.time()
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                self._decay(conn, now)
+                conn.executemany(
+                    """INSERT INTO section_popularity(book_code, sec_id, score, plays, combats, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(book_code, sec_id) DO UPDATE SET
+                           score      = section_popularity.score + excluded.score,
+                           plays      = section_popularity.plays + excluded.plays,
+                           combats    = section_popularity.combats + excluded.combats,
+                           updated_at = excluded.updated_at""",
+                    [(code, sec, float(p + c), p, c, now) for (code, sec), (p, c) in rows.items()],
+                )
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                # remet les hits en attente pour le prochain essai
+                for key, n in counts.items():
+                    self._hits.extend([key] * n)
+                raise
+            total = sum(counts.values())
+            self.flushes += 1
+            self.flushed_hits += total
+            return total
+
+    @staticmethod
+    def _decay(conn: sqlite3.Connection, now: float) -> None:
+        row = conn.execute("SELECT value FROM popularity_meta WHERE key='decayed_at'").fetchone()
+        if row is None:
+            conn.execute("INSERT INTO popularity_meta(key, value) VALUES ('decayed_at', ?)", (now,))
+            return
+        elapsed = now - row[0]
+        if elapsed < DECAY_EVERY:
+            return
+        conn.execute("UPDATE section_popularity SET score = score * ?", (0.5 ** (elapsed / HALF_LIFE),))
+        conn.execute("DELETE FROM section_popularity WHERE score < ?", (MIN_SCORE,))
+        conn.execute("UPDATE popularity_meta SET value=? WHERE key='decayed_at'", (now,))
+
+    # ---------- Lecture ----------
+
+    def top(self, n: int) -> List[Tuple[str, str, float]]:
+        """Les n sections les plus populaires : [(clé du livre, sec_id, score)]."""
+        if n <= 0:
+            return []
+        return self._connect().execute(
+            "SELECT book_code, sec_id, score FROM section_popularity ORDER BY score DESC LIMIT ?", (n,)
+        ).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sections les plus populaires")
+    parser.add_argument("--db", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "popularity.db"))
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+    for code, sec_id, score in PopularityRecorder(args.db).top(args.top):
+        print(f"{score:10.1f}  {code}/{sec_id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+progress.py
+-----------
+Sauvegarde de la progression des lecteurs : section courante, sections visitées,
+CS/EP et issues des combats, par (lecteur, livre).
+
+- Base séparée en mode WAL (data/progress.db) : lonewolf.db reste en lecture seule.
+- Les écritures passent par une file en mémoire (write-behind) : une mise à jour ne
+  coûte qu'une opération sur un dict ; un thread vide la file par lots, dans une
+  seule transaction, toutes les FLUSH_INTERVAL secondes (ou dès BATCH_SIZE entrées).
+- Seuls les champs modifiés sont écrits ; les mises à jour successives d'un même
+  (lecteur, livre) sont fusionnées. Plusieurs workers (serve.py) écrivent la même
+  base : un champ n'est remplacé que par une valeur plus récente que la ligne en base.
+- Pas d'état gardé d'une requête à l'autre : la lecture se fait en base, complétée
+  par les mises à jour de ce processus pas encore écrites.
+- Sections visitées encodées en bitset (bit n = section n) ; à l'écriture, le
+  bitset est combiné par OU avec celui déjà en base.
+- La base n'est ouverte (et son schéma créé) qu'au premier accès.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+FLUSH_INTERVAL = 0.5      # secondes
+BATCH_SIZE = 2000         # déclenche un vidage anticipé
+
+SCHEMA_SQL = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+
+CREATE TABLE IF NOT EXISTS reader_progress (
+    reader_id    TEXT NOT NULL,
+    book_code    TEXT NOT NULL,
+    current_sec  TEXT,
+    visited      BLOB,               -- bitset des numéros de section visités
+    lw_cs        INTEGER,
+    lw_ep        INTEGER,
+    updated_at   REAL NOT NULL,
+    PRIMARY KEY (reader_id, book_code)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS combat_outcomes (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    reader_id  TEXT NOT NULL,
+    book_code  TEXT NOT NULL,
+    sec_id     TEXT NOT NULL,
+    won        INTEGER NOT NULL,     -- 1 victoire, 0 défaite
+    rounds     INTEGER NOT NULL,
+    lw_ep      INTEGER,              -- EP restant du joueur
+    enemy_ep   INTEGER,
+    at         REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_outcomes_reader ON combat_outcomes(reader_id, book_code);
+"""
+
+
+# ---------- Bitset des sections visitées ----------
+
+def sect_number(sec_id: str) -> Optional[int]:
+    if sec_id and sec_id.startswith("sect") and sec_id[4:].isdigit():
+        return int(sec_id[4:])
+    return None
+
+def bitset_add(bits: bytearray, n: int) -> None:
+    byte = n >> 3
+    if byte >= len(bits):
+        bits.extend(b"\0" * (byte + 1 - len(bits)))
+    bits[byte] |= 1 << (n & 7)
+
+def bitset_has(bits: bytes, n: int) -> bool:
+    byte = n >> 3
+    return byte < len(bits) and bool(bits[byte] & (1 << (n & 7)))
+
+def bitset_members(bits: bytes) -> Iterator[int]:
+    for i, b in enumerate(bits):
+        while b:
+            low = b & -b
+            yield i * 8 + low.bit_length() - 1
+            b ^= low
+
+def bitset_or(a: Optional[bytes], b: Optional[bytes]) -> Optional[bytes]:
+    if not a:
+        return b
+    if not b:
+        return a
+    if len(a) < len(b):
+        a, b = b, a
+    out = bytearray(a)
+    for i, x in enumerate(b):
+        out[i] |= x
+    return bytes(out)
+
+
+class Progress:
+    __slots__ = ("current_sec", "visited", "lw_cs", "lw_ep", "updated_at")
+
+    def __init__(self, current_sec=None, visited=None, lw_cs=None, lw_ep=None, updated_at=0.0):
+        self.current_sec = current_sec
+        self.visited = bytearray(visited or b"")
+        self.lw_cs = lw_cs
+        self.lw_ep = lw_ep
+        self.updated_at = updated_at
+
+    @property
+    def visited_count(self) -> int:
+        return sum(bin(b).count("1") for b in self.visited)
+
+    def has_visited(self, sec_id: str) -> bool:
+        n = sect_number(sec_id)
+        return n is not None and bitset_has(self.visited, n)
+
+    def merge(self, other: "Progress") -> None:
+        """
+        Combine avec un autre état : pour chaque champ, la valeur renseignée la plus
+        récente (même règle que l'écriture en base) ; sections visitées réunies.
+        """
+        newer = other.updated_at > self.updated_at
+        for field in ("current_sec", "lw_cs", "lw_ep"):
+            value = getattr(other, field)
+            if value is not None and (newer or getattr(self, field) is None):
+                setattr(self, field, value)
+        self.visited = bytearray(bitset_or(bytes(self.visited), bytes(other.visited)) or b"")
+        self.updated_at = max(self.updated_at, other.updated_at)
+
+
+class ProgressStore:
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL, batch_size: int = BATCH_SIZE):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        # modifications en attente (seuls les champs modifiés sont renseignés)
+        self._dirty: Dict[Tuple[str, str], Progress] = {}
+        self._flushing: Dict[Tuple[str, str], Progress] = {}   # lot en cours d'écriture
+        self._outcomes: List[tuple] = []
+        self._conn_local = threading.local()
+        self._thread = None
+        self._pid = None
+        self._schema_ready = False
+        self.flushed_rows = 0
+        self.flushes = 0
+        atexit.register(self.flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._conn_local, "conn", None)
+        if conn is None or self._conn_local.pid != os.getpid():
+            if not self._schema_ready:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 10000")
+            conn.create_function("bitset_or", 2, bitset_or, deterministic=True)
+            if not self._schema_ready:
+                conn.executescript(SCHEMA_SQL)
+                self._schema_ready = True
+            self._conn_local.conn = conn
+            self._conn_local.pid = os.getpid()
+        return conn
+
+    def close(self) -> None:
+        """Ferme la connexion du thread courant (serve.py : avant un fork, cf. sqlite.org/howtocorrupt)."""
+        conn = getattr(self._conn_local, "conn", None)
+        if conn is not None:
+            self._conn_local.conn = None
+            conn.close()
+
+    # ---------- Thread d'écriture ----------
+
+    def _ensure_writer(self) -> None:
+        # (re)lance le thread après un fork (serve.py) : les threads ne sont pas hérités
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="progress-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                time.sleep(self.flush_interval)   # base verrouillée : on réessaiera au tour suivant
+
+    def flush(self) -> int:
+        """Écrit en une transaction toutes les mises à jour en attente."""
+        with self._lock:
+            if not self._dirty and not self._outcomes:
+                return 0
+            rows = [
+                (reader, book, p.current_sec, bytes(p.visited) or None, p.lw_cs, p.lw_ep, p.updated_at)
+                for (reader, book), p in self._dirty.items()
+            ]
+            outcomes, self._outcomes = self._outcomes, []
+            self._flushing, self._dirty = self._dirty, {}
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                """INSERT INTO reader_progress(reader_id, book_code, current_sec, visited, lw_cs, lw_ep, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(reader_id, book_code) DO UPDATE SET
+                       current_sec = CASE WHEN excluded.current_sec IS NOT NULL
+                                           AND excluded.updated_at >= reader_progress.updated_at
+                                          THEN excluded.current_sec ELSE reader_progress.current_sec END,
+                       visited     = bitset_or(reader_progress.visited, excluded.visited),
+                       lw_cs       = CASE WHEN excluded.lw_cs IS NOT NULL
+                                           AND excluded.updated_at >= reader_progress.updated_at
+                                          THEN excluded.lw_cs ELSE reader_progress.lw_cs END,
+                       lw_ep       = CASE WHEN excluded.lw_ep IS NOT NULL
+                                           AND excluded.updated_at >= reader_progress.updated_at
+                                          THEN excluded.lw_ep ELSE reader_progress.lw_ep END,
+                       updated_at  = MAX(excluded.updated_at, reader_progress.updated_at)""",
+                rows,
+            )
+            conn.executemany(
+                "INSERT INTO combat_outcomes(reader_id, book_code, sec_id, won, rounds, lw_ep, enemy_ep, at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                outcomes,
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            # remet les lignes en attente pour le prochain essai, sous les modifications plus récentes
+            with self._lock:
+                for key, p in self._flushing.items():
+                    if key in self._dirty:
+                        self._dirty[key].merge(p)
+                    else:
+                        self._dirty[key] = p
+                self._flushing = {}
+                self._outcomes[:0] = outcomes
+            raise
+        with self._lock:
+            self._flushing = {}
+        self.flushes += 1
+        self.flushed_rows += len(rows) + len(outcomes)
+        return len(rows) + len(outcomes)
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty) + len(self._outcomes)
+
+    # ---------- API ----------
+
+    def _pending(self, key: Tuple[str, str]) -> Progress:
+        """Modifications en attente pour (lecteur, livre) ; appelé sous verrou."""
+        p = self._dirty.get(key)
+        if p is None:
+            p = self._dirty[key] = Progress()
+            if len(self._dirty) >= self.batch_size:
+                self._wake.set()
+        p.updated_at = time.time()
+        return p
+
+    def get(self, reader: str, book: str) -> Optional[Progress]:
+        """État en base, complété par les modifications de ce processus pas encore écrites."""
+        key = (reader, book)
+        row = self._connect().execute(
+            "SELECT current_sec, visited, lw_cs, lw_ep, updated_at FROM reader_progress "
+            "WHERE reader_id=? AND book_code=?", key
+        ).fetchone()
+        p = Progress(*row) if row else Progress()
+        with self._lock:
+            for pending in (self._flushing.get(key), self._dirty.get(key)):
+                if pending is not None:
+                    p.merge(pending)
+        return p if p.current_sec or p.visited or p.lw_ep is not None else None
+
+    def visit(self, reader: str, book: str, sec_id: str) -> None:
+        self._ensure_writer()
+        n = sect_number(sec_id)
+        with self._lock:
+            p = self._pending((reader, book))
+            p.current_sec = sec_id
+            if n is not None:
+                bitset_add(p.visited, n)
+
+    def set_stats(self, reader: str, book: str, lw_cs: Optional[int], lw_ep: Optional[int]) -> None:
+        self._ensure_writer()
+        with self._lock:
+            p = self._pending((reader, book))
+            if lw_cs is not None:
+                p.lw_cs = lw_cs
+            if lw_ep is not None:
+                p.lw_ep = lw_ep
+
+    def record_combat(self, reader: str, book: str, sec_id: str, won: bool, rounds: int,
+                      lw_ep: Optional[int], enemy_ep: Optional[int]) -> None:
+        self._ensure_writer()
+        with self._lock:
+            self._outcomes.append((reader, book, sec_id, 1 if won else 0, rounds, lw_ep, enemy_ep, time.time()))
+            if len(self._outcomes) >= self.batch_size:
+                self._wake.set()
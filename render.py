@@ -0,0 +1,320 @@
+"""
+render.py
+---------
+Rendu HTML du content_xml des sections (balisage Project Aon), en une seule passe.
+
+- Le XML est parcouru une seule fois par une expression compilée (_TOKEN.sub) :
+  le texte est recopié tel quel, chaque balise est traduite via la table
+  HANDLERS (balise Aon -> HTML) ; choix et méta sont sautés d'un bloc.
+- Pile des éléments ouverts : balises mal fermées réparées, balises inconnues
+  rendues transparentes (leur texte est gardé, la balise disparaît).
+- Texte : '<' et '&' isolés sont échappés (les références d'entités XML sont déjà
+  du HTML valide), valeurs d'attributs échappées ; seuls les liens vers une
+  section (idref="sectN") ou vers http(s) produisent un <a href>.
+- Listes et tableaux imbriqués, notes de bas de page (<footref>/<footnotes>),
+  illustrations "inline" dans le fil du texte (les autres restent dans le panneau).
+
+Usage :
+    render_section(xml, section_url=lambda sec_id: ..., illustration_url=lambda src: ...)
+"""
+
+import re
+from html import escape, unescape
+from typing import Callable, Dict, List, Optional, Tuple
+
+from entities import ENTITIES
+
+_TOKEN = re.compile(
+    r"<(choice|meta|when|illustration)\b([^>]*?)(?<!/)>(.*?)</\1\s*>"  # sous-arbres ignorés / illustrations
+    r"|<(/)?([A-Za-z_][\w.:\-]*)([^>]*?)(/)?>"                          # balise ouvrante / fermante / auto-fermante
+    r"|<!--.*?-->|<\?.*?\?>|<|&(?!#?\w+;)",                             # commentaires, PI, '<' et '&' isolés
+    re.DOTALL,
+)
+_ATTR = re.compile(r"""([\w:.\-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+_SECT_REF = re.compile(r"sect\d+")
+_CSS_SAFE = re.compile(r"[^\w\-]")
+
+_INSTANCE = re.compile(r"<instance\b([^>]*?)(/)?>", re.IGNORECASE)
+_INSTANCE_END = re.compile(r"</instance\s*>", re.IGNORECASE)
+_CREATOR = re.compile(r"<creator>(.*?)</creator>", re.IGNORECASE | re.DOTALL)
+
+# Entités <ch.xxx/> (nom sans le préfixe "ch.") -> HTML, depuis la table partagée ; inconnues -> supprimées
+CHARACTERS: Dict[str, str] = {name: escape(ch, quote=False) for name, ch in ENTITIES.items()}
+
+ENEMY_ATTRIBUTES = {"combatskill": "COMBAT SKILL", "endurance": "ENDURANCE"}
+
+
+def attrs_of(raw: str) -> Dict[str, str]:
+    if not raw:
+        return {}
+    return {m.group(1): m.group(2) if m.group(2) is not None else m.group(3) for m in _ATTR.finditer(raw)}
+
+
+def _text(s: str) -> str:
+    return escape(unescape(s) if "&" in s else s, quote=False)
+
+
+def _class(name: str, raw_class: Optional[str]) -> str:
+    classes = [name] if name else []
+    if raw_class:
+        classes += [f"{name or 'aon'}--{_CSS_SAFE.sub('', c)}" for c in raw_class.split()]
+    return f' class="{" ".join(classes)}"' if classes else ""
+
+
+class _State:
+    __slots__ = ("section_url", "illustration_url", "footrefs")
+
+    def __init__(self, section_url, illustration_url):
+        self.section_url = section_url
+        self.illustration_url = illustration_url
+        self.footrefs = 0
+
+
+# ---------- Table des balises ----------
+# Valeur : (ouverture, fermeture) fixes, SKIP (sous-arbre ignoré), ou
+# fonction(attrs_bruts, état) -> (ouverture, fermeture) | SKIP.
+
+SKIP = object()
+ILLUSTRATION = object()
+
+def _simple(tag: str, css: Optional[str] = None, after: str = "") -> Tuple[str, str]:
+    return (f"<{tag}{_class(css, None)}>", f"</{tag}>{after}")
+
+def _with_class(tag: str, css: Optional[str] = None):
+    plain = _simple(tag, css)
+
+    def handler(raw, _st):
+        if not raw:
+            return plain
+        return (f"<{tag}{_class(css, attrs_of(raw).get('class'))}>", plain[1])
+    return handler
+
+def _cell(tag: str):
+    def handler(raw, _st):
+        span = attrs_of(raw).get("colspan", "")
+        return (f'<{tag} colspan="{span}">' if span.isdigit() else f"<{tag}>", f"</{tag}>")
+    return handler
+
+def _link(raw, st):
+    a = attrs_of(raw)
+    ref = a.get("idref") or a.get("href") or ""
+    if st.section_url and _SECT_REF.fullmatch(ref):
+        return (f'<a href="{escape(st.section_url(ref))}">', "</a>")
+    if ref.startswith(("http://", "https://")):
+        return (f'<a href="{escape(ref)}" rel="noopener">', "</a>")
+    # renvoi vers une page annexe (Action Chart, table de hasard…) non servie par le site
+    return ('<span class="ref">', "</span>")
+
+def _typ(raw, _st):
+    return (f"<span{_class('typ', attrs_of(raw).get('class'))}>", "</span>")
+
+def _foreign(raw, _st):
+    lang = attrs_of(raw).get("xml:lang", "")
+    return (f'<i class="foreign" lang="{escape(lang)}">' if lang else '<i class="foreign">', "</i>")
+
+def _enemy_attribute(raw, _st):
+    cls = attrs_of(raw).get("class", "")
+    label = ENEMY_ATTRIBUTES.get(cls, cls.upper())
+    return (f'<span class="enemy-attr">{escape(label)} <b>', "</b></span>")
+
+def _footref(raw, st):
+    a = attrs_of(raw)
+    st.footrefs += 1
+    return (f'<sup class="footref"><a id="{escape(a.get("id", ""))}" href="#{escape(a.get("idref", ""))}">'
+            f"{st.footrefs}</a></sup>", "")
+
+def _footnote(raw, _st):
+    a = attrs_of(raw)
+    back = f' <a class="footnote-back" href="#{escape(a["idref"])}">↩</a>' if a.get("idref") else ""
+    return (f'<li id="{escape(a.get("id", ""))}">', f"{back}</li>")
+
+
+HANDLERS = {
+    # blocs
+    "p": _with_class("p"),
+    "blockquote": _simple("blockquote"),
+    "poetry": _simple("div", "poetry"),
+    "signpost": _simple("div", "signpost"),
+    "deadend": _simple("p", "deadend"),
+    "puzzle": _simple("p", "puzzle"),
+    "section": _simple("div", "subsection"),
+    "title": _simple("h3", "subsection-title"),
+    "combat": _simple("div", "combat-block"),
+    # listes / tableaux
+    "ul": _with_class("ul"),
+    "ol": _with_class("ol"),
+    "list": _simple("ul"),
+    "li": _simple("li"),
+    "dl": _simple("dl"),
+    "dt": _simple("dt"),
+    "dd": _simple("dd"),
+    "table": _simple("table", "aon-table"),
+    "caption": _simple("caption"),
+    "tr": _simple("tr"),
+    "td": _cell("td"),
+    "th": _cell("th"),
+    # en ligne
+    "em": _simple("em"),
+    "strong": _simple("strong"),
+    "cite": _simple("cite"),
+    "bookref": _simple("cite", "bookref"),
+    "quote": _simple("q"),
+    "thought": _simple("em", "thought"),
+    "onomatopoeia": _simple("em", "onomatopoeia"),
+    "spell": _simple("em", "spell"),
+    "item": _simple("span", "item"),
+    "line": _simple("span", "line", after="<br>"),
+    "enemy": _simple("span", "enemy"),
+    "enemy-attribute": _enemy_attribute,
+    "typ": _typ,
+    "foreign": _foreign,
+    "a": _link,
+    # notes
+    "footref": _footref,
+    "footnotes": _simple("ol", "footnotes"),
+    "footnote": _footnote,
+    # ignorés : choix (affichés par le template), métadonnées, variantes conditionnelles
+    "choice": SKIP,
+    "meta": SKIP,
+    "link": SKIP,
+    "when": SKIP,
+    "illustration": ILLUSTRATION,
+}
+# transparentes : data, link-text, choose, otherwise, para… (et toute balise inconnue)
+_TRANSPARENT = ("", "")
+# handlers dont le résultat ne dépend que des attributs (mis en cache par texte de balise)
+_PURE_HANDLERS = {HANDLERS[t] for t in ("p", "ul", "ol", "td", "th", "typ", "foreign", "enemy-attribute")}
+
+
+# ---------- Illustrations ----------
+
+def _illustration(raw: str, inner: str, st: _State) -> str:
+    """Illustration "inline" : image si résolue, sinon son équivalent texte (tableau, panneau…)."""
+    if st.illustration_url is None or attrs_of(raw).get("class") != "inline":
+        return ""
+    instances = [(attrs_of(m.group(1)), m) for m in _INSTANCE.finditer(inner)]
+    by_class = {a.get("class"): (a, m) for a, m in instances}
+    creator = _CREATOR.search(inner)
+    alt = escape(unescape(re.sub(r"<[^>]+>", "", creator.group(1))).strip()) if creator else ""
+
+    for cls in ("html", "html-compatible"):
+        if cls in by_class:
+            url = st.illustration_url(by_class[cls][0].get("src", ""))
+            if url:
+                title = f' title="{alt}"' if alt else ""
+                return f'<figure class="illustration-inline"><img src="{escape(url)}" alt="Illustration"{title}></figure>'
+
+    text = by_class.get("text")
+    if text and not text[1].group(2):
+        end = _INSTANCE_END.search(inner, text[1].end())
+        body = inner[text[1].end(): end.start() if end else len(inner)]
+        return f'<figure class="illustration-text">{_render(body, st)}</figure>'
+    return ""
+
+
+# ---------- Rendu ----------
+
+# Résultats indépendants du contexte, par texte exact de balise (le corpus n'en
+# compte que quelques centaines) : "<p>" -> ("p", "<p>", "</p>"), "</p>" -> "p"…
+_OPEN_CACHE: Dict[str, Tuple[str, str, str]] = {}
+_CLOSE_CACHE: Dict[str, str] = {}
+_CHAR_CACHE: Dict[str, str] = {}
+_CACHE_MAX = 4096
+
+
+class _Renderer:
+    """Rappel de _TOKEN.sub() : le texte est recopié tel quel (en C), seules les balises passent ici."""
+
+    __slots__ = ("st", "stack")
+
+    def __init__(self, st: _State):
+        self.st = st
+        self.stack: List[Tuple[str, str]] = []   # (balise Aon, fermeture HTML)
+
+    def __call__(self, m) -> str:
+        if m.lastindex == 3:
+            # sous-arbre ignoré (choix, méta…) ou illustration
+            return _illustration(m.group(2), m.group(3), self.st) if m.group(1) == "illustration" else ""
+        tok = m.group(0)
+        stack = self.stack
+        # chemin rapide : balises déjà vues
+        name = _CLOSE_CACHE.get(tok)
+        if name is not None:
+            if stack and stack[-1][0] == name:
+                return stack.pop()[1]
+            return self._close(name)
+        hit = _OPEN_CACHE.get(tok)
+        if hit is not None:
+            stack.append((hit[0], hit[2]))
+            return hit[1]
+        ch = _CHAR_CACHE.get(tok)
+        if ch is not None:
+            return ch
+        return self._slow(m, tok)
+
+    def _close(self, name: str) -> str:
+        # referme jusqu'à la balise correspondante (ignorée si jamais ouverte)
+        stack = self.stack
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                closes = [c for _n, c in reversed(stack[i:])]
+                del stack[i:]
+                return "".join(closes)
+        return ""
+
+    def _slow(self, m, tok: str) -> str:
+        name = m.group(5)
+        if name is None:
+            if tok == "<":
+                return "&lt;"
+            return "&amp;" if tok == "&" else ""   # & isolé / commentaire, PI
+        cacheable = len(_OPEN_CACHE) + len(_CLOSE_CACHE) + len(_CHAR_CACHE) < _CACHE_MAX
+
+        if name.startswith("ch."):
+            ch = CHARACTERS.get(name[3:], "")
+            if cacheable:
+                _CHAR_CACHE[tok] = ch
+            return ch
+
+        if m.group(4):
+            if cacheable:
+                _CLOSE_CACHE[tok] = name
+            return self._close(name)
+
+        h = HANDLERS.get(name, _TRANSPARENT)
+        pure = h.__class__ is tuple or h in _PURE_HANDLERS
+        if h.__class__ is not tuple:
+            if h is SKIP or h is ILLUSTRATION:
+                return ""   # forme auto-fermante : rien à rendre
+            h = h(m.group(6), self.st)
+        if m.group(7):
+            return h[0] + h[1]
+        if pure and cacheable:
+            _OPEN_CACHE[tok] = (name, h[0], h[1])
+        self.stack.append((name, h[1]))
+        return h[0]
+
+
+def _render(xml: str, st: _State) -> str:
+    r = _Renderer(st)
+    html = _TOKEN.sub(r, xml)
+    if r.stack:
+        html += "".join(c for _n, c in reversed(r.stack))
+    return html
+
+
+def render_section(xml: str,
+                   section_url: Optional[Callable[[str], str]] = None,
+                   illustration_url: Optional[Callable[[str], Optional[str]]] = None) -> str:
+    """
+    HTML d'un content_xml de section.
+    - section_url(sec_id) : URL d'une autre section (sinon les renvois restent du texte)
+    - illustration_url(src) : URL d'une image (sinon les illustrations sont ignorées)
+    """
+    if not xml:
+        return ""
+    if "<" not in xml:
+        # texte brut : paragraphes séparés par une ligne vide
+        parts = [p.strip() for p in re.split(r"\n\s*\n", xml) if p.strip()]
+        return "".join(f"<p>{_text(p)}</p>" for p in parts)
+    return _render(xml, _State(section_url, illustration_url))
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+serve.py
+--------
+Point d'entrée de production (pré-fork) pour le site Flask.
+
+- Le processus maître précharge tout ce qui est partageable : CRT, templates
+  compilés, index des images, sections les plus populaires déjà rendues
+  (popularity.py) et, si LONEWOLF_MEMORY=1, le corpus en mémoire.
+- Il ouvre la socket d'écoute puis fork N workers ; chaque worker sert les
+  requêtes avec un pool de T threads. Les pages mémoire préchargées sont
+  partagées en copy-on-write (gc.freeze() évite que le GC ne les recopie).
+  Les connexions SQLite ouvertes par le maître (progression, popularité) sont
+  fermées avant chaque fork : chaque worker ouvre les siennes.
+- Métriques (/metrics, LONEWOLF_METRICS=1) : chaque worker n'expose que ses propres
+  compteurs, et un scrape tombe sur un worker quelconque. Elles ne sont donc
+  exploitables qu'avec --workers 1 (les threads d'un worker partagent le registre).
+- Contre-pression : au-delà de T connexions en cours + --queue en attente, un
+  worker répond 503 (Retry-After) et ferme la connexion au lieu de l'empiler.
+- Rechargement à chaud : quand la base est regénérée (build_version) ou sur
+  SIGHUP, le maître recharge les données, lance une nouvelle génération de
+  workers puis arrête proprement l'ancienne (les requêtes en cours se terminent).
+  Les anciens workers sont récoltés sans bloquer la boucle du maître, tués
+  après DRAIN_TIMEOUT secondes.
+- SIGTERM / SIGINT : arrêt propre de tous les workers ; un second signal les tue.
+
+Usage :
+    python serve.py --workers 4 --threads 8 --host 0.0.0.0 --port 8000
+
+Sous Windows (pas de fork), le serveur tourne dans un seul processus.
+"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+import app as site
+from corpus import read_build_version
+
+QUEUE_SIZE = 64         # connexions acceptées en attente d'un thread, par worker
+DRAIN_TIMEOUT = 30.0    # secondes laissées à un worker arrêté pour finir ses requêtes
+
+_BUSY_BODY = "Serveur surchargé, réessayez dans un instant.\n".encode("utf-8")
+BUSY_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Length: " + str(len(_BUSY_BODY)).encode() + b"\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n\r\n" + _BUSY_BODY
+)
+
+
+class RequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = 5            # ferme les connexions keep-alive inactives
+    access_log = False
+
+    def log_request(self, code="-", size="-"):
+        if self.access_log:
+            super().log_request(code, size)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Serveur WSGI werkzeug avec un pool de threads borné (au lieu d'un thread par requête)
+    et une file bornée : connexion refusée (503) quand threads + queue_size sont occupés.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, wsgi_app, threads, fd=None, handler=RequestHandler, queue_size=QUEUE_SIZE):
+        self.pool = None
+        super().__init__(host, port, wsgi_app, handler=handler, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="lw-req")
+        self._slots = threading.BoundedSemaphore(threads + queue_size)
+        self.rejected = 0
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            self._reject(request)
+            return
+        self.pool.submit(self._process_request_thread, request, client_address)
+
+    def _reject(self, request):
+        try:
+            request.settimeout(1.0)
+            request.sendall(BUSY_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        # attend la fin des requêtes en cours
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        super().server_close()
+
+
+# ---------- Préchargement (processus maître) ----------
+
+def preload():
+    started = time.perf_counter()
+    flask_app = site.app
+    for name in flask_app.jinja_env.list_templates():
+        flask_app.jinja_env.get_template(name)
+    site.get_asset_index()
+    if site.MEMORY_MODE and site.CORPUS is None:
+        site.load_corpus()
+    # les workers ne vérifient pas eux-mêmes la base : c'est le maître qui recharge
+    site.BUILD_CHECK_INTERVAL = float("inf")
+    # une connexion SQLite ne doit pas traverser un fork : les workers rouvrent les leurs
+    for store in (site.PROGRESS, site.POPULARITY):
+        if store is not None:
+            store.close()
+    # objets préchargés exclus du GC : pas d'écriture dans leurs pages après le fork
+    gc.collect()
+    gc.freeze()
+    print(f"[serve] préchargement en {time.perf_counter() - started:.2f} s "
+          f"(CRT: {'oui' if site.CRT else 'fallback'}, corpus: {'oui' if site.CORPUS else 'non'}, "
+          f"sections populaires: {site.PRELOAD_STATS['sections']})",
+          file=sys.stderr)
+
+
+def reload_data(version):
+    gc.unfreeze()
+    site._build["version"] = version
+    # sections populaires préchargées dans le maître, héritées par les nouveaux workers
+    site.on_build_change(background=False)
+    preload()
+
+
+# ---------- Workers ----------
+
+def worker_main(sock, threads, queue_size):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, site.app, threads, fd=sock.fileno(), queue_size=queue_size)
+
+    def stop(_signum, _frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        # os._exit() saute les handlers atexit : on vide ici les files de progression et de popularité
+        if site.PROGRESS is not None:
+            site.PROGRESS.flush()
+        if site.POPULARITY is not None:
+            site.POPULARITY.flush()
+
+
+def spawn(sock, threads, queue_size):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            worker_main(sock, threads, queue_size)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def stop_workers(pids, draining, timeout=DRAIN_TIMEOUT):
+    """SIGTERM aux workers ; ils passent dans `draining` (pid -> échéance), récoltés par reap()."""
+    deadline = time.monotonic() + timeout
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        draining[pid] = deadline
+
+
+def reap(draining):
+    """
+    Récolte sans bloquer les workers terminés ; renvoie ceux qui n'étaient pas en arrêt
+    (morts inopinément). Un worker en arrêt au-delà de son échéance est tué.
+    """
+    dead = []
+    while True:
+        try:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            draining.clear()   # plus aucun fils
+            break
+        if not pid:
+            break
+        if draining.pop(pid, None) is None:
+            dead.append(pid)
+    now = time.monotonic()
+    for pid, deadline in draining.items():
+        if now >= deadline:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            draining[pid] = float("inf")   # récolté au prochain tour
+    return dead
+
+
+# ---------- Maître ----------
+
+def serve(host, port, workers, threads, check_interval, queue_size=QUEUE_SIZE):
+    # sections populaires rendues dans le maître, avant le gel du GC et le fork
+    site.preload_popular()
+    preload()
+    version = read_build_version(site.DB_PATH)
+    site._build["version"] = version
+
+    if not hasattr(os, "fork"):
+        print(f"[serve] pas de fork disponible : 1 processus, {threads} threads sur http://{host}:{port}",
+              file=sys.stderr)
+        PooledWSGIServer(host, port, site.app, threads, queue_size=queue_size).serve_forever()
+        return
+
+    sock = socket.create_server((host, port), backlog=1024, reuse_port=False)
+    sock.set_inheritable(True)
+    print(f"[serve] {workers} workers × {threads} threads sur http://{host}:{port}", file=sys.stderr)
+    if workers > 1 and site.metrics.ENABLED:
+        print("[serve] attention : /metrics ne reflète que le worker qui répond ; "
+              "utiliser --workers 1 pour des métriques exploitables", file=sys.stderr)
+
+    flags = {"stop": False, "force": False, "reload": False}
+
+    def on_stop(*_):
+        flags["force"] = flags["stop"]    # second signal : on n'attend plus les workers
+        flags["stop"] = True
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, lambda *_: flags.update(reload=True))
+
+    pids = {spawn(sock, threads, queue_size) for _ in range(workers)}
+    draining = {}   # anciens workers en cours d'arrêt : pid -> échéance
+    last_check = time.monotonic()
+    try:
+        while not flags["stop"]:
+            time.sleep(0.2)
+
+            # worker mort inopinément -> on le remplace
+            for pid in reap(draining):
+                if pid in pids:
+                    pids.discard(pid)
+                    if not flags["stop"]:
+                        pids.add(spawn(sock, threads, queue_size))
+
+            if time.monotonic() - last_check >= check_interval:
+                last_check = time.monotonic()
+                new_version = read_build_version(site.DB_PATH)
+                if new_version != version:
+                    flags["reload"] = True
+
+            if flags["reload"]:
+                flags["reload"] = False
+                version = read_build_version(site.DB_PATH)
+                print(f"[serve] rechargement (build {version})", file=sys.stderr)
+                reload_data(version)
+                old = pids
+                pids = {spawn(sock, threads, queue_size) for _ in range(workers)}
+                stop_workers(old, draining)
+    finally:
+        stop_workers(pids, draining)
+        while draining:
+            if flags["force"]:
+                for pid in draining:
+                    draining[pid] = 0.0
+            reap(draining)
+            time.sleep(0.05)
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur de production pré-fork (Lone Wolf).")
+    parser.add_argument("--host", default=os.environ.get("LONEWOLF_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("LONEWOLF_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("LONEWOLF_WORKERS", os.cpu_count() or 1)))
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("LONEWOLF_THREADS", "8")))
+    parser.add_argument("--queue", type=int, default=int(os.environ.get("LONEWOLF_QUEUE", str(QUEUE_SIZE))),
+                        help="connexions en attente par worker au-delà desquelles on répond 503")
+    parser.add_argument("--check-interval", type=float, default=site.BUILD_CHECK_INTERVAL,
+                        help="secondes entre deux vérifications de la version de la base")
+    parser.add_argument("--access-log", action="store_true", help="journalise chaque requête")
+    args = parser.parse_args()
+
+    RequestHandler.access_log = args.access_log
+    serve(args.host, args.port, max(1, args.workers), max(1, args.threads), args.check_interval, max(0, args.queue))
+
+
+if __name__ == "__main__":
+    main()